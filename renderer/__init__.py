@@ -39,6 +39,7 @@ from .caching import (
 from .xml_builders import (
     extract_allowed_rating_keys,
     extract_preview_targets,
+    prepare_preview_targets,
 )
 
 from .proxy_plex import PlexProxy
@@ -85,6 +86,7 @@ __all__ = [
     # XML
     'extract_allowed_rating_keys',
     'extract_preview_targets',
+    'prepare_preview_targets',
     # Proxies
     'PlexProxy',
     'TMDbProxy',
@@ -6,6 +6,7 @@ configuration files for preview rendering.
 """
 
 import http.client
+import io
 import json
 import re
 import xml.etree.ElementTree as ET
@@ -86,20 +87,21 @@ def _read_yaml(path: Path) -> Dict[str, Any]:
 
 def sanitize_yaml_text(text: str) -> str:
     """Sanitize YAML text by removing extraneous document end markers."""
-    lines = text.splitlines()
-    last_non_empty = -1
-    for idx in range(len(lines) - 1, -1, -1):
-        if lines[idx].strip():
-            last_non_empty = idx
-            break
-
-    sanitized_lines = []
-    for idx, line in enumerate(lines):
-        if line.strip() == '...' and idx != last_non_empty:
-            continue
+    sanitized_lines: List[Optional[str]] = []
+    # Index of the most recent '...' marker; dropped once any later
+    # non-empty line shows it is not the final line of the document.
+    pending_marker = -1
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped:
+            if pending_marker >= 0:
+                sanitized_lines[pending_marker] = None
+                pending_marker = -1
+            if stripped == '...':
+                pending_marker = len(sanitized_lines)
         sanitized_lines.append(line)
 
-    sanitized = '\n'.join(sanitized_lines)
+    sanitized = '\n'.join(line for line in sanitized_lines if line is not None)
     if text.endswith('\n'):
         sanitized += '\n'
     return sanitized
@@ -237,19 +239,24 @@ def validate_library_sections(
     except ET.ParseError as e:
         raise RuntimeError(f"Failed to parse /library/sections response: {e}. Snippet: {snippet}")
 
-    sections = []
-    for directory in root.findall('Directory'):
-        sections.append({
-            'title': directory.get('title', ''),
+    # Direct child iteration; equivalent to findall('Directory') without the
+    # ElementPath selector machinery. First section with a given title wins.
+    sections_by_title: Dict[str, Dict[str, str]] = {}
+    for directory in root:
+        if directory.tag != 'Directory':
+            continue
+        title = directory.get('title', '')
+        sections_by_title.setdefault(title, {
+            'title': title,
             'type': directory.get('type', ''),
             'key': directory.get('key', ''),
         })
 
-    if not sections:
+    if not sections_by_title:
         raise RuntimeError(f"/library/sections returned no sections. Snippet: {snippet}")
 
     for name in selected_libraries:
-        match = next((s for s in sections if s['title'] == name), None)
+        match = sections_by_title.get(name)
         if not match:
             raise RuntimeError(
                 f"Selected library '{name}' not found in /library/sections. Snippet: {snippet}"
@@ -343,19 +350,20 @@ def generate_proxy_config(job_path: Path, preview_config: Dict[str, Any], proxy_
         if libraries:
             kometa_config['libraries'] = libraries
 
-    with open(kometa_config_path, 'w') as f:
-        if yaml_backend == 'pyyaml' and pyyaml:
-            pyyaml.dump(kometa_config, f, default_flow_style=False)
-        elif yaml_backend == 'ruamel':
-            from ruamel.yaml import YAML
-            ruamel_yaml = YAML()
-            ruamel_yaml.default_flow_style = False
-            ruamel_yaml.dump(kometa_config, f)
-        else:
-            json.dump(kometa_config, f, indent=2)
-
-    sanitized_text = sanitize_yaml_text(kometa_config_path.read_text())
-    kometa_config_path.write_text(sanitized_text)
+    # Render in memory and sanitize before the single write, rather than
+    # writing, reading back and rewriting the file.
+    rendered = io.StringIO()
+    if yaml_backend == 'pyyaml' and pyyaml:
+        pyyaml.dump(kometa_config, rendered, default_flow_style=False)
+    elif yaml_backend == 'ruamel':
+        from ruamel.yaml import YAML
+        ruamel_yaml = YAML()
+        ruamel_yaml.default_flow_style = False
+        ruamel_yaml.dump(kometa_config, rendered)
+    else:
+        json.dump(kometa_config, rendered, indent=2)
+
+    kometa_config_path.write_text(sanitize_yaml_text(rendered.getvalue()))
 
     parsed_config = load_yaml_file(kometa_config_path)
     missing_keys = [key for key in ('plex', 'tmdb', 'libraries') if key not in parsed_config]
@@ -139,6 +139,11 @@ LIBRARY_LISTING_PATTERNS = [
     re.compile(r'^/library/recentlyAdded\b'),              # Global recently added
 ]
 
+# All listing patterns as one alternation, so a path is checked in a single match
+LIBRARY_LISTING_PATTERN = re.compile(
+    '|'.join(f'(?:{pattern.pattern})' for pattern in LIBRARY_LISTING_PATTERNS)
+)
+
 # Metadata endpoint pattern - to block access to non-allowed items
 METADATA_PATTERN = re.compile(r'^/library/metadata/(\d+)(?:/.*)?(?:\?.*)?$')
 
@@ -152,17 +157,32 @@ ARTWORK_PATTERNS = [
 LIBRARY_SECTIONS_PATTERN = re.compile(r'^/library/sections(?:\?.*)?$')
 # Pattern to match specific section requests: /library/sections/{id}
 # This is used when Kometa queries section details
-LIBRARY_SECTION_DETAIL_PATTERN = re.compile(r'^/library/sections/(\d+)(?:\?.*)?$')
+LIBRARY_SECTION_DETAIL_PATTERN = re.compile(r'^/library/sections/(\d+)(?:\?|$)')
 
 # Section ID extraction pattern
 SECTION_ID_PATTERN = re.compile(r'^/library/sections/(\d+)/')
 
 # Children endpoint pattern (for getting seasons of a show, episodes of a season)
-CHILDREN_PATTERN = re.compile(r'^/library/metadata/(\d+)/children(?:\?.*)?$')
+CHILDREN_PATTERN = re.compile(r'^/library/metadata/(\d+)/children(?:\?|$)')
 
 # Filter types endpoint pattern - used by plexapi.library.listFilters()
 # This is called when Kometa uses plex_search with attributes like resolution, audio_codec, etc.
-LIBRARY_FILTER_TYPES_PATTERN = re.compile(r'^/library/sections/(\d+)/filterTypes(?:\?.*)?$')
+LIBRARY_FILTER_TYPES_PATTERN = re.compile(r'^/library/sections/(\d+)/filterTypes(?:\?|$)')
+
+# Collections endpoint pattern (matched against the path without query string or trailing slash)
+LIBRARY_COLLECTIONS_PATTERN = re.compile(r'^/library/sections/(\d+)/collections$')
+
+# Section "all" listing without query string - used for proxy traffic sanity checks
+LIBRARY_SECTION_ALL_PATTERN = re.compile(r'^/library/sections/\d+/all$')
+
+# Last-resort ratingKey extraction for upload paths: any numeric path segment
+UPLOAD_RATING_KEY_FALLBACK_PATTERN = re.compile(r'/(\d+)/')
+
+# boundary parameter of a multipart Content-Type (value still needs its quotes stripped)
+MULTIPART_BOUNDARY_PATTERN = re.compile(r'(?:^|;)\s*boundary=([^;]*)')
+
+# type attribute of the first Directory in a synthetic section document
+MOCK_DIRECTORY_TYPE_PATTERN = re.compile(rb'<Directory\b[^>]*?\stype="([^"]*)"')
 
 # ============================================================================
 # TMDb API Patterns
@@ -196,3 +216,23 @@ TMDB_LIST_ENDPOINTS = [
     '/network/',
     '/company/',
 ]
+
+# Discover query parameters that indicate a collection/chart builder rather
+# than an overlay evaluation:
+# - with_genres (genre collections)
+# - with_keywords (keyword collections)
+# - certification (certification collections)
+# - with_runtime (runtime collections)
+# - with_companies/with_networks/with_people/with_cast/with_crew
+TMDB_NON_OVERLAY_DISCOVER_PARAMS = frozenset({
+    'with_genres',
+    'with_keywords',
+    'certification',
+    'certification_country',
+    'with_runtime',
+    'with_companies',
+    'with_networks',
+    'with_people',
+    'with_cast',
+    'with_crew',
+})
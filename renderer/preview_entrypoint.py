@@ -25,7 +25,6 @@ Usage:
 import argparse
 import json
 import os
-import re
 import sys
 import traceback
 from datetime import datetime
@@ -48,6 +47,7 @@ from constants import (
     OUTPUT_CACHE_ENABLED,
     PARALLEL_KOMETA_ENABLED,
     FAST_PATH_ENABLED,
+    LIBRARY_SECTION_ALL_PATTERN,
 )
 from fonts import validate_fonts_at_startup, ensure_font_fallbacks
 from caching import (
@@ -64,7 +64,7 @@ from overlay_fingerprints import (
     filter_preview_config_for_targets,
     detect_overlay_complexity,
 )
-from xml_builders import extract_allowed_rating_keys
+from xml_builders import extract_allowed_rating_keys, get_preview_index
 from proxy_plex import PlexProxy
 from proxy_tmdb import TMDbProxy
 from config import (
@@ -379,8 +379,9 @@ def main():
 
         # Validate sections endpoint for selected libraries
         selected_libraries = list(preview_config.get('libraries', {}).keys())
-        has_movies = any(t.get('type') in ('movie', 'movies') for t in targets)
-        has_shows = any(t.get('type') in ('show', 'shows', 'series', 'season', 'episode') for t in targets)
+        target_index = get_preview_index(proxy.preview_targets)
+        has_movies = target_index.has_movies
+        has_shows = target_index.has_shows
         expected_type = None
         if has_movies and not has_shows:
             expected_type = 'movie'
@@ -504,7 +505,7 @@ def main():
 
         sections_all_count = sum(
             1 for req in request_log
-            if req.get('method') == 'GET' and re.match(r'^/library/sections/\d+/all$', req.get('path_base', ''))
+            if req.get('method') == 'GET' and LIBRARY_SECTION_ALL_PATTERN.match(req.get('path_base', ''))
         )
 
         # Traffic sanity check: ensure proxy is in the request path (skip for fast path)
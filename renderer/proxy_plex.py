@@ -5,15 +5,16 @@ This module provides the PlexProxyHandler and PlexProxy classes that intercept
 Plex API calls, block writes, and capture uploaded images for preview generation.
 """
 
+import gzip
 import http.client
-import re
 import ssl
 import threading
+import zlib
 import xml.etree.ElementTree as ET
 from datetime import datetime
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Set, Tuple
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple
 from urllib.parse import urlparse
 
 from constants import (
@@ -24,9 +25,11 @@ from constants import (
     DEBUG_MOCK_XML,
     PLEX_UPLOAD_PATTERN,
     RATING_KEY_EXTRACT_PATTERNS,
+    UPLOAD_RATING_KEY_FALLBACK_PATTERN,
+    MOCK_DIRECTORY_TYPE_PATTERN,
 )
 from xml_builders import (
-    filter_media_container_xml,
+    filter_media_container_xml_with_counts,
     create_empty_media_container_xml,
     is_listing_endpoint,
     is_metadata_endpoint,
@@ -42,14 +45,151 @@ from xml_builders import (
     build_synthetic_section_detail_xml,
     build_synthetic_filter_types_xml,
     build_synthetic_collections_xml,
-    build_synthetic_listing_xml,
-    build_synthetic_children_xml,
+    build_synthetic_listing_xml_with_count,
+    build_synthetic_children_xml_with_count,
+    prepare_preview_targets,
     extract_image_from_body,
     is_image_data,
     detect_image_type,
     parse_multipart_image,
 )
 
+# Optional libdeflate bindings for whole-buffer gzip decompression
+try:
+    import deflate as _deflate
+except ImportError:
+    _deflate = None
+
+# Optional lxml backend for scanning metadata responses. Entity resolution
+# and network access are disabled.
+try:
+    from lxml import etree as _LET
+    _METADATA_PARSE_ERRORS: Tuple[type, ...] = (ET.ParseError, _LET.XMLSyntaxError)
+except ImportError:
+    _LET = None
+    _METADATA_PARSE_ERRORS = (ET.ParseError,)
+
+# Bytes of a response inspected when sniffing its content kind
+_SNIFF_PREFIX = 256
+
+# Bytes fed to the pull parser per step when scanning metadata responses
+_METADATA_SCAN_CHUNK = 16384
+
+# Maximum number of rendered mock listings (or children) kept per cache
+_MOCK_XML_CACHE_MAX = 64
+
+
+def _sniff_content_kind(body: bytes) -> str:
+    """
+    Classify a response body from its first bytes.
+
+    Only a bounded prefix is inspected, so large bodies are never copied or
+    scanned in full.
+
+    Returns:
+        'gzip', 'html', 'xml' (starts with '<' after whitespace) or 'other'
+    """
+    if body[:2] == b'\x1f\x8b':
+        return 'gzip'
+    head = body[:_SNIFF_PREFIX].lstrip()
+    if not head and len(body) > _SNIFF_PREFIX:
+        # Unusually long leading whitespace; fall back to a full strip
+        head = body.lstrip()[:_SNIFF_PREFIX]
+    if not head.startswith(b'<'):
+        return 'other'
+    head = head.lower()
+    if head.startswith(b'<!doctype html') or b'<html' in head:
+        return 'html'
+    return 'xml'
+
+
+def _new_metadata_pull_parser():
+    """Create a pull parser reporting element start/end events."""
+    if _LET is not None:
+        return _LET.XMLPullParser(
+            events=('start', 'end'),
+            resolve_entities=False,
+            no_network=True,
+            huge_tree=False,
+        )
+    return ET.XMLPullParser(events=('start', 'end'))
+
+
+def _scan_metadata_item(body: bytes, rating_key: str) -> Tuple[Optional[str], Optional[Dict[str, str]]]:
+    """
+    Find the item attributes in a metadata response without building the tree.
+
+    The body is fed to a pull parser in chunks and scanning stops at the
+    first top-level child whose ratingKey matches, so nested Media/Genre/Role
+    elements after it are never parsed. Well-formedness is therefore only
+    checked up to that point. If no child matches, the first child is used.
+
+    Args:
+        body: Response body bytes
+        rating_key: ratingKey the response was requested for
+
+    Returns:
+        Tuple of (root tag, item attributes or None)
+
+    Raises:
+        One of _METADATA_PARSE_ERRORS if the scanned part is malformed
+    """
+    parser = _new_metadata_pull_parser()
+    root_tag = None
+    first_item = None
+    depth = 0
+    for offset in range(0, len(body), _METADATA_SCAN_CHUNK):
+        parser.feed(body[offset:offset + _METADATA_SCAN_CHUNK])
+        for event, elem in parser.read_events():
+            if event == 'end':
+                depth -= 1
+                continue
+            depth += 1
+            if depth == 1:
+                root_tag = elem.tag
+                if root_tag != 'MediaContainer':
+                    return root_tag, None
+            elif depth == 2:
+                if elem.get('ratingKey') == rating_key:
+                    return root_tag, dict(elem.attrib)
+                if first_item is None:
+                    first_item = dict(elem.attrib)
+    parser.close()
+    return root_tag, first_item
+
+
+def _decompress_gzip(body: bytes) -> bytes:
+    """
+    Decompress a fully buffered gzip body.
+
+    Uses libdeflate when available, which sizes its output from the gzip
+    ISIZE trailer. Otherwise a single-member body is inflated with one zlib
+    call; gzip.decompress (which reads members through a buffered stream)
+    is only used for multi-member or otherwise unusual input.
+    """
+    if _deflate is not None:
+        try:
+            return _deflate.gzip_decompress(body)
+        except Exception:
+            pass
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        data = inflater.decompress(body)
+    except zlib.error:
+        return gzip.decompress(body)
+    if inflater.eof and not inflater.unused_data:
+        return data
+    return gzip.decompress(body)
+
+
+def _decompress_deflate(body: bytes) -> bytes:
+    """
+    Decompress a fully buffered HTTP deflate (zlib-wrapped) body.
+
+    zlib streams carry no uncompressed size, so this stays on the stdlib.
+    """
+    return zlib.decompress(body)
+
 
 class PlexProxyHandler(BaseHTTPRequestHandler):
     """
@@ -74,7 +214,7 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
     job_path: str = ''
 
     # Filtering configuration (set from preview config)
-    allowed_rating_keys: Set[str] = set()
+    allowed_rating_keys: FrozenSet[str] = frozenset()
     filtering_enabled: bool = False
 
     # Mock library mode configuration
@@ -84,6 +224,12 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
     # Metadata cache for learning parent relationships
     # Key: ratingKey, Value: dict of attributes from metadata response
     metadata_cache: Dict[str, Dict[str, str]] = {}
+    # Bumped whenever metadata_cache changes; part of the listing memo key
+    metadata_cache_version: int = 0
+    # Rendered mock listings keyed by (section_id, query, include_meta, cache version)
+    listing_xml_cache: Dict[Tuple[Optional[str], Optional[str], bool, int], Tuple[int, bytes]] = {}
+    # Rendered mock children keyed by (parent ratingKey, cache version)
+    children_xml_cache: Dict[Tuple[str, int], Tuple[int, bytes]] = {}
     # Dynamically learned parent ratingKeys (parents of allowed items)
     parent_rating_keys: Set[str] = set()
 
@@ -111,7 +257,7 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
 
     def _record_request(self, method: str):
         """Record all incoming requests for diagnostics and traffic sanity checks."""
-        path_base = self.path.split('?')[0]
+        path_base = self.path.partition('?')[0]
         is_validation = self.headers.get('X-Preview-Validation', '') == '1'
 
         entry = {
@@ -133,75 +279,68 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
 
         logger.info(f"PROXY_REQUEST method={method} path={path_base}")
 
+    def _route_mock_children(self, children_parent: str):
+        """Serve children for allowed parents, block everything else."""
+        # Check if parent is in our allowlist or is a parent of allowed items
+        if children_parent in self.allowed_rating_keys or children_parent in self.parent_rating_keys:
+            self._handle_mock_children(children_parent)
+        else:
+            # Block children requests for non-allowed parents
+            logger.info(f"BLOCK_CHILDREN parentRatingKey={children_parent} not allowed")
+            self._send_empty_container()
+            with self.data_lock:
+                self.blocked_metadata_count += 1
+
+    # Mock-mode GET routes in priority order: (name, detector, handler).
+    # The first detector returning a truthy value wins and its result is
+    # passed to the handler, so each request is classified in one pass.
+    # - filterTypes fixes "Unknown libtype 'movie' ... Available libtypes: ['collection']" (P0)
+    # - filterTypes and collections must precede section detail, which
+    #   would otherwise match the more general pattern (P0 libtype fix)
+    # - section detail ensures Kometa sees the preview library type rather than
+    #   whatever library happens to be at that ID on the real Plex server
+    _MOCK_GET_ROUTES = (
+        ('sections', is_library_sections_endpoint,
+         lambda self, path, match: self._handle_mock_sections()),
+        ('filter_types', is_filter_types_endpoint,
+         lambda self, path, match: self._handle_mock_filter_types(match)),
+        ('collections', is_collections_endpoint,
+         lambda self, path, match: self._handle_mock_collections(match)),
+        ('section_detail', is_library_section_detail_endpoint,
+         lambda self, path, match: self._handle_mock_section_detail(match)),
+        ('listing', is_listing_endpoint,
+         lambda self, path, match: self._handle_mock_listing(path)),
+        ('children', is_children_endpoint,
+         lambda self, path, match: self._route_mock_children(match)),
+    )
+
+    def _match_mock_get_route(self, path: str):
+        """Return (name, handler, match) for the first matching mock route, or None."""
+        for name, detector, handler in self._MOCK_GET_ROUTES:
+            match = detector(path)
+            if match:
+                return name, handler, match
+        return None
+
     def do_GET(self):
         """Forward GET requests to real Plex (or return synthetic XML in mock mode)"""
         self._record_request('GET')
         path = self.path
-        path_base = path.split('?')[0]
-        is_listing = is_listing_endpoint(path)
-        is_meta = is_metadata_endpoint(path)
-        is_sections = is_library_sections_endpoint(path)
-        filter_types_section_id = is_filter_types_endpoint(path)
-        collections_section_id = is_collections_endpoint(path)
-        section_detail_id = is_library_section_detail_endpoint(path)
-        children_parent = is_children_endpoint(path)
+        path_base = path.partition('?')[0]
+        route = self._match_mock_get_route(path)
 
         logger.info(
-            f"PROXY_GET path={path_base} is_listing={is_listing} "
-            f"is_metadata={is_meta} is_sections={is_sections} "
-            f"section_detail={section_detail_id is not None} "
-            f"filter_types={filter_types_section_id is not None} "
-            f"collections={collections_section_id is not None}"
+            f"PROXY_GET path={path_base} route={route[0] if route else 'forward'} "
+            f"is_metadata={is_metadata_endpoint(path)}"
         )
 
-        # Mock library mode: return synthetic XML for listing endpoints
-        if self.mock_mode_enabled and self.allowed_rating_keys:
-            # Handle /library/sections endpoint
-            if is_sections:
-                self._handle_mock_sections()
-                return
-
-            # Handle /library/sections/{id}/filterTypes - P0 fix for plex_search validation
-            # This must be checked BEFORE section_detail to avoid matching the more general pattern
-            # Fixes "Unknown libtype 'movie' ... Available libtypes: ['collection']" error
-            if filter_types_section_id:
-                self._handle_mock_filter_types(filter_types_section_id)
-                return
-
-            # Handle /library/sections/{id}/collections - P0 libtype fix
-            # This prevents PlexAPI from querying real Plex and learning the wrong library type
-            # Must be checked BEFORE section_detail to avoid matching the more general pattern
-            if collections_section_id:
-                self._handle_mock_collections(collections_section_id)
-                return
-
-            # Handle /library/sections/{id} (specific section detail) - P0 libtype fix
-            # This ensures Kometa sees the correct type (movie/show) instead of
-            # whatever library happens to be at that ID on the real Plex server
-            if section_detail_id:
-                self._handle_mock_section_detail(section_detail_id)
-                return
-
-            # Handle listing endpoints (all, search, browse)
-            if is_listing:
-                self._handle_mock_listing(path)
-                return
-
-            # Handle /library/metadata/{id}/children endpoint
-            if children_parent:
-                # Check if parent is in our allowlist or is a parent of allowed items
-                if children_parent in self.allowed_rating_keys or children_parent in self.parent_rating_keys:
-                    self._handle_mock_children(children_parent)
-                    return
-                else:
-                    # Block children requests for non-allowed parents
-                    logger.info(f"BLOCK_CHILDREN parentRatingKey={children_parent} not allowed")
-                    self._send_empty_container()
-                    with self.data_lock:
-                        self.blocked_metadata_count += 1
-                    return
+        # Mock library mode: return synthetic XML for library endpoints
+        if route and self.mock_mode_enabled and self.allowed_rating_keys:
+            _, handler, match = route
+            handler(self, path, match)
+            return
 
-        # Not in mock mode or not a listing endpoint - use standard forwarding
+        # Not in mock mode or not a mock endpoint - use standard forwarding
         self._forward_request('GET')
 
     def do_HEAD(self):
@@ -233,6 +372,7 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
         """Forward a read request to the real Plex server, with optional filtering and caching"""
         try:
             path = self.path
+            is_metadata = is_metadata_endpoint(path)
 
             # Check if filtering is enabled and this is a filtered endpoint type
             should_filter_listing = (
@@ -245,14 +385,14 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
             should_block_metadata = (
                 self.filtering_enabled and
                 self.allowed_rating_keys and
-                is_metadata_endpoint(path)
+                is_metadata
             )
 
             # Check if this is a metadata request that we should cache
             should_cache_metadata = (
                 self.mock_mode_enabled and
                 self.allowed_rating_keys and
-                is_metadata_endpoint(path)
+                is_metadata
             )
 
             # If this is a metadata endpoint, check if it's allowed
@@ -272,7 +412,7 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
                         self.blocked_metadata_count += 1
                     return
                 elif rating_key and is_allowed:
-                    logger.info(f"ALLOW_FORWARD ratingKey={rating_key} endpoint={path.split('?')[0]}")
+                    logger.info(f"ALLOW_FORWARD ratingKey={rating_key} endpoint={path.partition('?')[0]}")
 
             # Create connection to real Plex
             if self.real_plex_scheme == 'https':
@@ -318,16 +458,14 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
             content_encoding = response.getheader('Content-Encoding', '').lower()
             if content_encoding == 'gzip':
                 try:
-                    import gzip
-                    response_body = gzip.decompress(response_body)
+                    response_body = _decompress_gzip(response_body)
                     was_decompressed = True
                     logger.debug(f"Decompressed gzip response for {path}")
                 except Exception as e:
                     logger.warning(f"Failed to decompress gzip response: {e}")
             elif content_encoding == 'deflate':
                 try:
-                    import zlib
-                    response_body = zlib.decompress(response_body)
+                    response_body = _decompress_deflate(response_body)
                     was_decompressed = True
                     logger.debug(f"Decompressed deflate response for {path}")
                 except Exception as e:
@@ -338,7 +476,7 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
                 self.forward_request_count += 1
 
             logger.info(
-                f"FORWARDED method={method} path={path.split('?')[0]} status={response.status}"
+                f"FORWARDED method={method} path={path.partition('?')[0]} status={response.status}"
             )
 
             # Cache metadata response for parent relationship learning
@@ -353,31 +491,17 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
                 if 'xml' in content_type.lower() or response_body.strip().startswith(b'<'):
                     original_size = len(response_body)
 
-                    # Count items before filtering for accurate logging
-                    try:
-                        root = ET.fromstring(response_body)
-                        original_item_count = sum(
-                            1 for child in root if child.get('ratingKey') is not None
+                    # The filter counts items as it goes, so the body isn't
+                    # parsed again for the log line
+                    filtered_body, original_item_count, filtered_item_count = (
+                        filter_media_container_xml_with_counts(
+                            response_body, self.allowed_rating_keys
                         )
-                    except Exception:
-                        original_item_count = -1
-
-                    filtered_body = filter_media_container_xml(
-                        response_body, self.allowed_rating_keys
                     )
 
-                    # Count items after filtering
-                    try:
-                        filtered_root = ET.fromstring(filtered_body)
-                        filtered_item_count = sum(
-                            1 for child in filtered_root if child.get('ratingKey') is not None
-                        )
-                    except Exception:
-                        filtered_item_count = -1
-
                     # Log the filtering with item counts
                     logger.info(
-                        f"FILTER_LIST endpoint={path.split('?')[0]} "
+                        f"FILTER_LIST endpoint={path.partition('?')[0]} "
                         f"items_before={original_item_count} items_after={filtered_item_count} "
                         f"allowed_keys={len(self.allowed_rating_keys)}"
                     )
@@ -397,12 +521,12 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
                     response_body = filtered_body
                 else:
                     logger.warning(
-                        f"FILTER_SKIP_NON_XML endpoint={path.split('?')[0]} "
+                        f"FILTER_SKIP_NON_XML endpoint={path.partition('?')[0]} "
                         f"content_type={content_type}"
                     )
             elif should_filter_listing:
                 logger.warning(
-                    f"FILTER_SKIP_STATUS endpoint={path.split('?')[0]} "
+                    f"FILTER_SKIP_STATUS endpoint={path.partition('?')[0]} "
                     f"status={response.status}"
                 )
 
@@ -455,12 +579,8 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
         if DEBUG_MOCK_XML:
             logger.debug(f"MOCK_SECTIONS_XML: {xml_bytes[:500].decode('utf-8', errors='replace')}")
 
-        # Parse to count sections
-        try:
-            root = ET.fromstring(xml_bytes)
-            section_count = len(list(root))
-        except Exception:
-            section_count = -1
+        # Count sections in the document we just built; no need to parse it
+        section_count = xml_bytes.count(b'<Directory ')
 
         logger.info(f"MOCK_SECTIONS returned_sections={section_count}")
 
@@ -488,15 +608,9 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
         if DEBUG_MOCK_XML:
             logger.debug(f"MOCK_SECTION_DETAIL_XML: {xml_bytes[:500].decode('utf-8', errors='replace')}")
 
-        # Parse to get section type
-        section_type = 'unknown'
-        try:
-            root = ET.fromstring(xml_bytes)
-            directory = root.find('Directory')
-            if directory is not None:
-                section_type = directory.get('type', 'unknown')
-        except Exception:
-            pass
+        # Read the section type back from the document we just built
+        match = MOCK_DIRECTORY_TYPE_PATTERN.search(xml_bytes)
+        section_type = match.group(1).decode('utf-8', errors='replace') if match else 'unknown'
 
         logger.info(f"MOCK_SECTION_DETAIL section_id={section_id} type={section_type}")
 
@@ -529,13 +643,8 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
         if DEBUG_MOCK_XML:
             logger.debug(f"MOCK_FILTER_TYPES_XML: {xml_bytes[:500].decode('utf-8', errors='replace')}")
 
-        # Parse to get filter type count
-        filter_type_count = 0
-        try:
-            root = ET.fromstring(xml_bytes)
-            filter_type_count = len(list(root))
-        except Exception:
-            pass
+        # Count filter types in the document we just built
+        filter_type_count = xml_bytes.count(b'<Type ')
 
         logger.info(f"MOCK_FILTER_TYPES section_id={section_id} type_count={filter_type_count}")
 
@@ -591,26 +700,27 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
         section_id = extract_section_id(path)
         query = extract_search_query(path)
 
-        xml_bytes = build_synthetic_listing_xml(
-            self.preview_targets,
-            section_id=section_id,
-            query=query,
-            metadata_cache=self.metadata_cache,
-            path=path
-        )
+        # Kometa re-polls the same listings; the output only changes when the
+        # metadata cache does, so identical requests reuse the rendered bytes
+        cache_key = (section_id, query, 'includeMeta=1' in path, self.metadata_cache_version)
+        cached = self.listing_xml_cache.get(cache_key)
+        if cached is not None:
+            item_count, xml_bytes = cached
+        else:
+            item_count, xml_bytes = build_synthetic_listing_xml_with_count(
+                self.preview_targets,
+                section_id=section_id,
+                query=query,
+                metadata_cache=self.metadata_cache,
+                path=path
+            )
+            self._store_rendered_xml(self.listing_xml_cache, cache_key, item_count, xml_bytes)
 
         # Debug logging
         if DEBUG_MOCK_XML:
             logger.debug(f"MOCK_LIST_XML: {xml_bytes[:500].decode('utf-8', errors='replace')}")
 
-        # Parse to count items
-        try:
-            root = ET.fromstring(xml_bytes)
-            item_count = int(root.get('size', '0'))
-        except Exception:
-            item_count = -1
-
-        path_base = path.split('?')[0]
+        path_base = path.partition('?')[0]
         logger.info(f"MOCK_LIST endpoint={path_base} returned_items={item_count}")
 
         # H3/H4: Track zero-match searches for diagnostic summary
@@ -631,25 +741,39 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
 
         self._send_xml_response(xml_bytes)
 
+    def _store_rendered_xml(
+        self,
+        cache: Dict[Tuple, Tuple[int, bytes]],
+        cache_key: Tuple,
+        item_count: int,
+        xml_bytes: bytes
+    ):
+        """Store a rendered mock document, evicting the oldest entry when full."""
+        with self.data_lock:
+            if len(cache) >= _MOCK_XML_CACHE_MAX:
+                cache.pop(next(iter(cache)))
+            cache[cache_key] = (item_count, xml_bytes)
+
     def _handle_mock_children(self, parent_rating_key: str):
         """Handle /library/metadata/{id}/children in mock mode."""
-        xml_bytes = build_synthetic_children_xml(
-            parent_rating_key,
-            self.preview_targets,
-            metadata_cache=self.metadata_cache
-        )
+        # Seasons and episodes are re-requested per overlay pass; like
+        # listings, they only change when the metadata cache does
+        cache_key = (parent_rating_key, self.metadata_cache_version)
+        cached = self.children_xml_cache.get(cache_key)
+        if cached is not None:
+            child_count, xml_bytes = cached
+        else:
+            child_count, xml_bytes = build_synthetic_children_xml_with_count(
+                parent_rating_key,
+                self.preview_targets,
+                metadata_cache=self.metadata_cache
+            )
+            self._store_rendered_xml(self.children_xml_cache, cache_key, child_count, xml_bytes)
 
         # Debug logging
         if DEBUG_MOCK_XML:
             logger.debug(f"MOCK_CHILDREN_XML: {xml_bytes[:500].decode('utf-8', errors='replace')}")
 
-        # Parse to count children
-        try:
-            root = ET.fromstring(xml_bytes)
-            child_count = int(root.get('size', '0'))
-        except Exception:
-            child_count = -1
-
         logger.info(f"MOCK_CHILDREN parentRatingKey={parent_rating_key} returned_items={child_count}")
 
         with self.data_lock:
@@ -682,53 +806,39 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
             return
 
         # Validation: Check response starts with XML
-        response_stripped = response_body.strip()
-        if not response_stripped.startswith(b'<'):
+        content_kind = _sniff_content_kind(response_body)
+        if content_kind != 'xml':
             # Log first bytes for debugging (safely)
             first_bytes = response_body[:120].decode('utf-8', errors='replace')
             logger.warning(
                 f"CACHE_METADATA_SKIP ratingKey={rating_key}: "
-                f"not XML (starts with: {repr(first_bytes[:60])})"
-            )
-            return
-
-        # Validation: Quick check for MediaContainer
-        if b'MediaContainer' not in response_body and b'mediacontainer' not in response_body.lower():
-            first_bytes = response_body[:120].decode('utf-8', errors='replace')
-            logger.warning(
-                f"CACHE_METADATA_SKIP ratingKey={rating_key}: "
-                f"no MediaContainer (content: {repr(first_bytes[:60])})"
+                f"not XML ({content_kind}, starts with: {repr(first_bytes[:60])})"
             )
             return
 
+        # Validation: MediaContainer root. The scan stops at the first start
+        # tag when the root is anything else, so no whole-body search is needed
         try:
-            root = ET.fromstring(response_body)
+            root_tag, item_attrs = _scan_metadata_item(response_body, rating_key)
 
             # Validation: Verify root is MediaContainer
-            if root.tag != 'MediaContainer':
+            if root_tag != 'MediaContainer':
                 logger.warning(
                     f"CACHE_METADATA_SKIP ratingKey={rating_key}: "
-                    f"root element is {root.tag}, expected MediaContainer"
+                    f"root element is {root_tag}, expected MediaContainer"
                 )
                 return
 
-            # Find the main item element (Video, Directory, etc.)
-            item = None
-            for child in root:
-                if child.get('ratingKey') == rating_key:
-                    item = child
-                    break
-
-            if item is None and len(list(root)) > 0:
-                # Sometimes the item is the root's first child
-                item = list(root)[0]
-
-            if item is not None:
+            # The main item element (Video, Directory, etc.); falls back to
+            # the root's first child when no child carries this ratingKey
+            if item_attrs is not None:
                 # Cache the attributes
-                cached_attrs = dict(item.attrib)
+                cached_attrs = item_attrs
 
                 with self.data_lock:
-                    self.metadata_cache[rating_key] = cached_attrs
+                    if PlexProxyHandler.metadata_cache.get(rating_key) != cached_attrs:
+                        PlexProxyHandler.metadata_cache[rating_key] = cached_attrs
+                        PlexProxyHandler.metadata_cache_version += 1
 
                     # Learn parent relationships
                     parent_key = cached_attrs.get('parentRatingKey')
@@ -746,7 +856,7 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
             else:
                 logger.debug(f"CACHE_METADATA_NO_ITEM ratingKey={rating_key}: no matching item found")
 
-        except ET.ParseError as e:
+        except _METADATA_PARSE_ERRORS as e:
             # Log detailed debug info for parse errors
             first_bytes = response_body[:120].decode('utf-8', errors='replace')
             logger.warning(
@@ -839,13 +949,13 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
                     capture_record['saved_path'] = saved_path
                     capture_record['size_bytes'] = len(image_bytes)
                     logger.info(
-                        f"UPLOAD_CAPTURED ratingKey={save_key} path={self.path.split('?')[0]} "
+                        f"UPLOAD_CAPTURED ratingKey={save_key} path={self.path.partition('?')[0]} "
                         f"content_type={content_type} bytes={len(image_bytes)} saved={saved_path}"
                     )
                 else:
                     capture_record['parse_error'] = 'No image data found in body'
                     logger.warning(
-                        f"UPLOAD_IGNORED: {method} {self.path.split('?')[0]} "
+                        f"UPLOAD_IGNORED: {method} {self.path.partition('?')[0]} "
                         f"reason=no_image_data content_type={content_type} "
                         f"content_length={content_length}"
                     )
@@ -854,7 +964,7 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
             except Exception as e:
                 capture_record['parse_error'] = str(e)
                 logger.error(
-                    f"UPLOAD_CAPTURE_ERROR: {method} {self.path.split('?')[0]} "
+                    f"UPLOAD_CAPTURE_ERROR: {method} {self.path.partition('?')[0]} "
                     f"ratingKey={rating_key} error={e}"
                 )
                 # Save raw body for debugging
@@ -891,7 +1001,7 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
 
         Returns: (ratingKey or None, kind)
         """
-        path_base = path.split('?')[0]
+        path_base = path.partition('?')[0]
 
         # Try standard upload pattern first
         match = PLEX_UPLOAD_PATTERN.match(path_base)
@@ -916,7 +1026,7 @@ class PlexProxyHandler(BaseHTTPRequestHandler):
                 return match.group(1), kind
 
         # Fallback: try to find any numeric ID in path
-        fallback_match = re.search(r'/(\d+)/', path)
+        fallback_match = UPLOAD_RATING_KEY_FALLBACK_PATTERN.search(path)
         if fallback_match:
             return fallback_match.group(1), kind
 
@@ -1026,8 +1136,9 @@ class PlexProxy:
         self.real_plex_url = real_plex_url.rstrip('/')
         self.plex_token = plex_token
         self.job_path = job_path
-        self.allowed_rating_keys = allowed_rating_keys or set()
-        self.preview_targets = preview_targets or []
+        # Frozen so the filter can reuse its encoded copy of the allowlist
+        self.allowed_rating_keys = frozenset(allowed_rating_keys or ())
+        self.preview_targets = prepare_preview_targets(preview_targets or [])
 
         # Parse the real Plex URL
         parsed = urlparse(real_plex_url)
@@ -1067,6 +1178,9 @@ class PlexProxy:
         PlexProxyHandler.mock_mode_enabled = self._mock_mode_enabled
         PlexProxyHandler.preview_targets = self.preview_targets
         PlexProxyHandler.metadata_cache = {}
+        PlexProxyHandler.metadata_cache_version = 0
+        PlexProxyHandler.listing_xml_cache = {}
+        PlexProxyHandler.children_xml_cache = {}
         PlexProxyHandler.parent_rating_keys = set()
 
         # Load persistent metadata cache if available
@@ -1127,6 +1241,7 @@ class PlexProxy:
             import json
             data = json.loads(cache_file.read_text())
             PlexProxyHandler.metadata_cache = data.get('metadata_cache', {})
+            PlexProxyHandler.metadata_cache_version += 1
             PlexProxyHandler.parent_rating_keys = set(data.get('parent_keys', []))
             logger.info(
                 f"Loaded metadata cache: {len(PlexProxyHandler.metadata_cache)} items, "
@@ -5,6 +5,7 @@ This module provides the TMDbProxyHandler and TMDbProxy classes that intercept
 TMDb API calls and cap results in FAST mode to speed up preview generation.
 """
 
+import functools
 import hashlib
 import http.client
 import json
@@ -13,7 +14,7 @@ import threading
 from datetime import datetime
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from typing import Any, Dict, List, Optional, Tuple
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs, unquote_plus
 
 from constants import (
     logger,
@@ -21,9 +22,122 @@ from constants import (
     TMDB_PROXY_PORT,
     TMDB_PAGINATED_ENDPOINTS,
     TMDB_LIST_ENDPOINTS,
+    TMDB_NON_OVERLAY_DISCOVER_PARAMS,
 )
 
 
+# Optional faster JSON codec for capping large TMDb responses
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _loads_json(body: bytes) -> Any:
+    """Parse a JSON response body, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def _dumps_json(data: Any) -> bytes:
+    """Serialize data to JSON bytes, using orjson when available."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(data)
+        except TypeError:
+            # e.g. integers beyond 64 bits; the stdlib handles those
+            pass
+    return json.dumps(data).encode('utf-8')
+
+
+def _scan_query(query: str, keys: frozenset) -> Dict[str, str]:
+    """
+    Return the first non-blank value of each requested query key.
+
+    Decodes names and values the way parse_qs does, but only builds entries
+    for the keys asked for and skips decoding values of any other key.
+    Anything after '#' is a fragment and is ignored, as urlparse would.
+    """
+    found: Dict[str, str] = {}
+    for part in query.partition('#')[0].split('&'):
+        name, _, value = part.partition('=')
+        if not value:
+            continue
+        if '%' in name or '+' in name:
+            name = unquote_plus(name)
+        if name in keys and name not in found:
+            found[name] = unquote_plus(value)
+    return found
+
+
+# Query keys read by the FAST mode detectors
+_DISCOVER_QUERY_KEYS = TMDB_NON_OVERLAY_DISCOVER_PARAMS | {'vote_count.gte'}
+_FIND_QUERY_KEYS = frozenset({'external_source'})
+
+
+# Fixed bodies for suppressed FAST mode requests, serialized once
+# G2: valid paginated response with empty results
+_EMPTY_PAGED_RESPONSE = json.dumps({
+    'page': 1,
+    'results': [],
+    'total_pages': 1,
+    'total_results': 0
+}).encode('utf-8')
+
+# H1: external_ids response with every ID (including TVDb) null
+_EMPTY_EXTERNAL_IDS_RESPONSE = json.dumps({
+    'id': None,
+    'imdb_id': None,
+    'freebase_mid': None,
+    'freebase_id': None,
+    'tvdb_id': None,
+    'tvrage_id': None,
+    'wikidata_id': None,
+    'facebook_id': None,
+    'instagram_id': None,
+    'twitter_id': None
+}).encode('utf-8')
+
+
+# Kometa repeats the same discover/page requests many times per run
+@functools.lru_cache(maxsize=8192)
+def compute_request_fingerprint(method: str, path: str) -> str:
+    """
+    Compute a stable fingerprint for request deduplication.
+
+    G1: Fingerprint is based on:
+    - HTTP method
+    - Endpoint path (without query string)
+    - Query params (sorted alphabetically)
+    """
+    # Parse path and query
+    parsed = urlparse(path)
+    query_params = parse_qs(parsed.query)
+
+    # Hash a length-prefixed field layout rather than formatting the sorted
+    # params into a string; length prefixes keep field boundaries unambiguous
+    hasher = hashlib.blake2b(digest_size=16)
+
+    def add_field(value: str):
+        data = value.encode('utf-8', errors='surrogatepass')
+        hasher.update(len(data).to_bytes(4, 'big'))
+        hasher.update(data)
+
+    add_field(method)
+    add_field(parsed.path)
+    # Sort query params (and each param's values) for a stable fingerprint
+    for key in sorted(query_params):
+        values = query_params[key]
+        add_field(key)
+        hasher.update(len(values).to_bytes(4, 'big'))
+        for value in sorted(values):
+            add_field(value)
+
+    # Return hash for compact representation
+    return hasher.hexdigest()
+
+
 class TMDbProxyHandler(BaseHTTPRequestHandler):
     """
     HTTP proxy handler that intercepts TMDb API calls and caps results in FAST mode.
@@ -75,6 +189,7 @@ class TMDbProxyHandler(BaseHTTPRequestHandler):
         try:
             # Parse the target URL from the request
             path = self.path
+            path_base = path.partition('?')[0]
 
             # Increment request counter
             with self.data_lock:
@@ -86,7 +201,7 @@ class TMDbProxyHandler(BaseHTTPRequestHandler):
             # G2: In FAST mode, skip discover requests for non-overlay contexts
             # (collections, charts, defaults builders)
             if self.fast_mode and self._is_non_overlay_discover(path):
-                logger.info(f"FAST_PREVIEW: skipped TMDb discover for non-overlay context: {path.split('?')[0]}")
+                logger.info(f"FAST_PREVIEW: skipped TMDb discover for non-overlay context: {path_base}")
                 with self.data_lock:
                     self.skipped_non_overlay += 1
                 # Return empty results
@@ -111,7 +226,7 @@ class TMDbProxyHandler(BaseHTTPRequestHandler):
                 if fingerprint in self.request_cache:
                     response_body, status_code, headers = self.request_cache[fingerprint]
                     self.cache_hits += 1
-                    logger.info(f"TMDB_CACHE_HIT: {path.split('?')[0]} (fingerprint={fingerprint[:12]})")
+                    logger.info(f"TMDB_CACHE_HIT: {path_base} (fingerprint={fingerprint[:12]})")
 
                     # Send cached response
                     self.send_response(status_code)
@@ -129,25 +244,22 @@ class TMDbProxyHandler(BaseHTTPRequestHandler):
 
             # Cap results if in FAST mode and this is a paginated endpoint
             if should_cap and status_code == 200:
-                original_body = response_body
-                response_body, was_capped = self._cap_tmdb_response(response_body, path)
+                response_body, was_capped, original_total, capped_count = self._cap_tmdb_response(
+                    response_body, path
+                )
 
                 if was_capped:
-                    # Log the capping
+                    # Log the capping (counts returned by the capping step, so
+                    # neither body is parsed again)
                     try:
-                        original_data = json.loads(original_body)
-                        capped_data = json.loads(response_body)
-                        original_total = original_data.get('total_results', len(original_data.get('results', [])))
-                        capped_count = len(capped_data.get('results', []))
-
                         logger.info(
-                            f"FAST_PREVIEW: capped TMDb {path.split('?')[0]} results "
+                            f"FAST_PREVIEW: capped TMDb {path_base} results "
                             f"from {original_total} -> {capped_count}"
                         )
 
                         with self.data_lock:
                             self.capped_requests.append({
-                                'path': path.split('?')[0],
+                                'path': path_base,
                                 'original_total': original_total,
                                 'capped_to': capped_count,
                                 'timestamp': datetime.now().isoformat()
@@ -195,31 +307,8 @@ class TMDbProxyHandler(BaseHTTPRequestHandler):
         return False
 
     def _compute_request_fingerprint(self, method: str, path: str) -> str:
-        """
-        Compute a stable fingerprint for request deduplication.
-
-        G1: Fingerprint is based on:
-        - HTTP method
-        - Endpoint path (without query string)
-        - Query params (sorted alphabetically)
-        """
-        # Parse path and query
-        parsed = urlparse(path)
-        path_base = parsed.path
-        query_params = parse_qs(parsed.query)
-
-        # Sort query params for stable fingerprint
-        # Convert lists to tuples and sort by key
-        sorted_params = sorted(
-            ((k, tuple(sorted(v))) for k, v in query_params.items()),
-            key=lambda x: x[0]
-        )
-
-        # Create fingerprint string
-        fingerprint_str = f"{method}:{path_base}:{sorted_params}"
-
-        # Return hash for compact representation
-        return hashlib.md5(fingerprint_str.encode()).hexdigest()
+        """Compute a stable fingerprint for request deduplication."""
+        return compute_request_fingerprint(method, path)
 
     def _is_non_overlay_discover(self, path: str) -> bool:
         """
@@ -233,45 +322,27 @@ class TMDbProxyHandler(BaseHTTPRequestHandler):
         These are detected by checking for specific query patterns that indicate
         the request is for building collections rather than evaluating overlays.
         """
-        path_base = path.split('?')[0]
+        path_base, _, query = path.partition('?')
 
         # Only check discover endpoints
         if '/discover/' not in path_base:
             return False
 
+        # Every indicator needs a value, so a query without '=' has none
+        if '=' not in query:
+            return False
+
         # Check query parameters for non-overlay indicators
-        parsed = urlparse(path)
-        query_params = parse_qs(parsed.query)
-
-        # Indicators of collection/chart builders (non-overlay contexts):
-        # - with_genres (genre collections)
-        # - with_keywords (keyword collections)
-        # - certification (certification collections)
-        # - with_runtime (runtime collections)
-        # - vote_count.gte with high threshold (popularity charts)
-        # - primary_release_date (decade/year collections)
-
-        non_overlay_indicators = [
-            'with_genres',
-            'with_keywords',
-            'certification',
-            'certification_country',
-            'with_runtime',
-            'with_companies',
-            'with_networks',
-            'with_people',
-            'with_cast',
-            'with_crew',
-        ]
+        query_params = _scan_query(query, _DISCOVER_QUERY_KEYS)
 
         # If any of these query params are present with values,
-        # this is likely a collection builder, not an overlay evaluation
-        for indicator in non_overlay_indicators:
-            if indicator in query_params and query_params[indicator]:
-                return True
+        # this is likely a collection builder, not an overlay evaluation.
+        # Blank values are skipped, so every key present has a value.
+        if not TMDB_NON_OVERLAY_DISCOVER_PARAMS.isdisjoint(query_params):
+            return True
 
         # High vote_count threshold suggests a chart/popularity builder
-        vote_count_gte = query_params.get('vote_count.gte', ['0'])[0]
+        vote_count_gte = query_params.get('vote_count.gte', '0')
         try:
             if int(vote_count_gte) >= 100:
                 # This looks like a chart builder (e.g., "popular movies")
@@ -288,15 +359,10 @@ class TMDbProxyHandler(BaseHTTPRequestHandler):
         Returns a valid paginated response with empty results, so Kometa
         can continue without error.
         """
-        empty_response = {
-            'page': 1,
-            'results': [],
-            'total_pages': 1,
-            'total_results': 0
-        }
-
-        response_body = json.dumps(empty_response).encode('utf-8')
+        self._send_json_bytes(_EMPTY_PAGED_RESPONSE)
 
+    def _send_json_bytes(self, response_body: bytes):
+        """Send a prebuilt JSON body with a 200 status."""
         self.send_response(200)
         self.send_header('Content-Type', 'application/json;charset=utf-8')
         self.send_header('Content-Length', str(len(response_body)))
@@ -316,17 +382,15 @@ class TMDbProxyHandler(BaseHTTPRequestHandler):
         - /tv/{id}/external_ids - TV show external IDs (includes tvdb_id)
         - /find/{external_id}?external_source=tvdb_id - TVDb -> TMDb lookups
         """
-        path_base = path.split('?')[0]
+        path_base, _, query = path.partition('?')
 
         # Match /tv/{id}/external_ids
         if '/tv/' in path_base and '/external_ids' in path_base:
             return True
 
         # Match /find/ with tvdb_id source
-        if '/find/' in path_base:
-            parsed = urlparse(path)
-            query_params = parse_qs(parsed.query)
-            external_source = query_params.get('external_source', [''])[0]
+        if '/find/' in path_base and '=' in query:
+            external_source = _scan_query(query, _FIND_QUERY_KEYS).get('external_source')
             if external_source == 'tvdb_id':
                 return True
 
@@ -339,27 +403,7 @@ class TMDbProxyHandler(BaseHTTPRequestHandler):
         Returns a valid external_ids response with null TVDb ID, so Kometa
         can continue without error but won't attempt further TVDb operations.
         """
-        # Empty external_ids response structure
-        empty_response = {
-            'id': None,
-            'imdb_id': None,
-            'freebase_mid': None,
-            'freebase_id': None,
-            'tvdb_id': None,
-            'tvrage_id': None,
-            'wikidata_id': None,
-            'facebook_id': None,
-            'instagram_id': None,
-            'twitter_id': None
-        }
-
-        response_body = json.dumps(empty_response).encode('utf-8')
-
-        self.send_response(200)
-        self.send_header('Content-Type', 'application/json;charset=utf-8')
-        self.send_header('Content-Length', str(len(response_body)))
-        self.end_headers()
-        self.wfile.write(response_body)
+        self._send_json_bytes(_EMPTY_EXTERNAL_IDS_RESPONSE)
 
     def _forward_to_tmdb(self, method: str, path: str) -> Tuple[bytes, int, List[Tuple[str, str]]]:
         """Forward request to real TMDb API"""
@@ -398,40 +442,42 @@ class TMDbProxyHandler(BaseHTTPRequestHandler):
 
         return response_body, status_code, response_headers
 
-    def _cap_tmdb_response(self, response_body: bytes, path: str) -> Tuple[bytes, bool]:
+    def _cap_tmdb_response(self, response_body: bytes, path: str) -> Tuple[bytes, bool, Any, int]:
         """
         Cap TMDb response results to the configured limit.
 
-        Returns: (capped_body, was_capped)
+        Returns: (capped_body, was_capped, original_total, capped_count). The
+        counts are only meaningful when was_capped is True.
         """
         try:
-            data = json.loads(response_body)
+            data = _loads_json(response_body)
 
             # Check if this is a paginated response
             if 'results' not in data:
-                return response_body, False
+                return response_body, False, 0, 0
 
             results = data.get('results', [])
             original_count = len(results)
 
             # Only cap if we have more results than the limit
             if original_count <= self.id_limit:
-                return response_body, False
+                return response_body, False, original_count, original_count
 
-            # Cap results
-            data['results'] = results[:self.id_limit]
+            # Cap results (truncate in place; the parsed list is ours)
+            del results[self.id_limit:]
+            original_total = data.get('total_results', original_count)
 
             # Update pagination info
-            data['total_results'] = len(data['results'])
+            data['total_results'] = len(results)
             data['total_pages'] = self.pages_limit
             if 'page' in data:
                 data['page'] = 1
 
-            return json.dumps(data).encode('utf-8'), True
+            return _dumps_json(data), True, original_total, len(results)
 
-        except (json.JSONDecodeError, KeyError, TypeError) as e:
+        except (ValueError, KeyError, TypeError) as e:
             logger.warning(f"TMDB_CAP_ERROR: Could not parse response for capping: {e}")
-            return response_body, False
+            return response_body, False, 0, 0
 
 
 class TMDbProxy:
@@ -517,4 +563,15 @@ class TMDbProxy:
                 'skipped_non_overlay': TMDbProxyHandler.skipped_non_overlay,
                 'skipped_tvdb_conversions': TMDbProxyHandler.skipped_tvdb_conversions,  # H1
                 'cache_size': len(TMDbProxyHandler.request_cache),
+                'fingerprint_cache': self._fingerprint_cache_stats(),
             }
+
+    @staticmethod
+    def _fingerprint_cache_stats() -> Dict[str, int]:
+        """Hit/miss counts and current size of the request fingerprint memo."""
+        info = compute_request_fingerprint.cache_info()
+        return {
+            'hits': info.hits,
+            'misses': info.misses,
+            'size': info.currsize,
+        }
@@ -31,6 +31,7 @@ from xml_builders import (
     build_synthetic_filter_types_xml,
     build_synthetic_listing_xml,
     build_synthetic_children_xml,
+    build_synthetic_listing_xml_with_count,
     is_library_sections_endpoint,
     is_children_endpoint,
     is_filter_types_endpoint,
@@ -39,9 +40,6 @@ from xml_builders import (
     extract_image_from_body,
 )
 from caching import safe_preview_targets
-from proxy_tmdb import TMDbProxyHandler
-from config import generate_proxy_config
-from sanitization import sanitize_overlay_data_for_fast_mode
 
 
 class TestFilterMediaContainerXML(unittest.TestCase):
@@ -181,6 +179,152 @@ class TestFilterMediaContainerXML(unittest.TestCase):
         result = filter_media_container_xml(invalid_xml, {'100'})
         self.assertEqual(result, invalid_xml)
 
+    def test_removes_nested_items_and_keeps_allowed_bytes(self):
+        """Removed items take their children with them; allowed items are copied verbatim"""
+        kept = b'<Video ratingKey="100" title="A &amp; B"><Media><Part file="a"/></Media></Video>'
+        xml_input = (
+            b'<MediaContainer size="2">\n    ' + kept +
+            b'\n    <Video ratingKey="200"><Media><Part/></Media></Video>\n</MediaContainer>'
+        )
+        result = filter_media_container_xml(xml_input, {'100'})
+        self.assertIn(kept, result)
+        root = ET.fromstring(result)
+        self.assertEqual(root.get('size'), '1')
+        self.assertEqual([v.get('ratingKey') for v in root.findall('Video')], ['100'])
+        self.assertEqual(len(root.findall('.//Part')), 1)
+
+    def test_fallback_path_keeps_xml_declaration(self):
+        """The ElementTree path reuses the input's UTF-8 declaration"""
+        from xml_builders import _filter_media_container_etree
+        xml_input = (
+            b'<?xml version="1.0" encoding="UTF-8"?>\n'
+            b'<MediaContainer size="2"><Video ratingKey="100" title="Am\xc3\xa9lie"/>'
+            b'<Video ratingKey="200"/></MediaContainer>'
+        )
+        result, original, filtered = _filter_media_container_etree(xml_input, {'100'})
+        self.assertTrue(result.startswith(b'<?xml version="1.0" encoding="UTF-8"?>\n<MediaContainer'))
+        self.assertEqual((original, filtered), (2, 1))
+        self.assertEqual(ET.fromstring(result).find('Video').get('title'), 'Am\u00e9lie')
+
+    def test_pure_python_scanner_matches_expat(self):
+        """The PyPy scanner splices the same items as the expat path"""
+        from xml_builders import _filter_media_container_expat, _filter_media_container_scan
+        xml_input = (
+            b'<?xml version="1.0" encoding="UTF-8"?>\n'
+            b'<MediaContainer size="3" totalSize="30" offset="10">\n'
+            b'  <Video title="a > b" ratingKey="100"><Media><Part/></Media></Video>\n'
+            b'  <Video ratingKey="200"/>\n'
+            b'  <Hub title="keep"/>\n'
+            b'</MediaContainer>'
+        )
+        scanned = _filter_media_container_scan(xml_input, {'100'})
+        self.assertEqual(scanned, _filter_media_container_expat(xml_input, {'100'}))
+        root = ET.fromstring(scanned[0])
+        self.assertEqual(
+            (root.get('size'), root.get('totalSize'), root.get('offset')), ('1', '1', '0')
+        )
+        self.assertEqual([child.tag for child in root], ['Video', 'Hub'])
+
+    def test_scanner_skips_quotes_inside_values(self):
+        """Apostrophes in double-quoted values don't move the tag end"""
+        from xml_builders import _filter_media_container_expat, _filter_media_container_scan
+        xml_input = (
+            b'<MediaContainer allowSync="1" size="3">\n'
+            b'  <Video ratingKey="100" title="Bob\'s > Movie"><Media summary=\'say "hi" > bye\'/></Video>\n'
+            b'  <Video ratingKey="200" title="It\'s"><Part file="a\'b"/></Video>\n'
+            b'  <Hub title="Bob\'s" key=\'a "b"\'/>\n'
+            b'</MediaContainer>'
+        )
+        scanned = _filter_media_container_scan(xml_input, {'100'})
+        self.assertEqual(scanned, _filter_media_container_expat(xml_input, {'100'}))
+        root = ET.fromstring(scanned[0])
+        self.assertEqual(root.get('size'), '1')
+        self.assertEqual([child.get('title') for child in root], ["Bob's > Movie", "Bob's"])
+
+        # A ratingKey="..." inside another attribute's value is not the item's key
+        hidden = b'<MediaContainer><Hub key=\'x ratingKey="1"\'/></MediaContainer>'
+        self.assertIsNone(_filter_media_container_scan(hidden, {'1'}))
+
+    def test_scanner_declines_other_rating_key_spellings(self):
+        """Whitespace around '=' is left to expat instead of keeping the item"""
+        from xml_builders import _filter_media_container_scan
+        xml_input = b'<MediaContainer size="2"><Video ratingKey = "9"/><Video ratingKey="1"/></MediaContainer>'
+        self.assertIsNone(_filter_media_container_scan(xml_input, {'1'}))
+        root = ET.fromstring(filter_media_container_xml(xml_input, {'1'}))
+        self.assertEqual(root.get('size'), '1')
+        self.assertEqual([child.get('ratingKey') for child in root], ['1'])
+
+    def test_unchanged_container_returned_as_is(self):
+        """Nothing to remove and sizes already correct returns the input object"""
+        xml_input = b'<MediaContainer size="1"><Video ratingKey="100"/></MediaContainer>'
+        self.assertIs(filter_media_container_xml(xml_input, {'100'}), xml_input)
+
+    def test_flat_container_skips_expat(self):
+        """Self-closing items are filtered by the scanner without expat"""
+        from unittest import mock
+        xml_input = (
+            b'<MediaContainer size="2">\n  <Video ratingKey="100"/>\n'
+            b'  <Video ratingKey="200"/>\n</MediaContainer>'
+        )
+        with mock.patch('xml_builders._filter_media_container_expat') as expat_filter:
+            result = filter_media_container_xml(xml_input, {'100'})
+        expat_filter.assert_not_called()
+        root = ET.fromstring(result)
+        self.assertEqual(root.get('size'), '1')
+        self.assertEqual([child.get('ratingKey') for child in root], ['100'])
+
+    def test_flat_container_keeps_items_after_apostrophes(self):
+        """A quote inside a value doesn't swallow the next flat item"""
+        from xml_builders import _filter_media_container_expat, filter_media_container_xml_with_counts
+        xml_input = b'<MediaContainer><Video ratingKey="1" title="Bob\'s" /><Video title="Bob\'s" /></MediaContainer>'
+        result = filter_media_container_xml_with_counts(xml_input, set())
+        self.assertEqual(result, _filter_media_container_expat(xml_input, set()))
+        root = ET.fromstring(result[0])
+        self.assertEqual(root.get('size'), '0')
+        self.assertEqual([child.get('title') for child in root], ["Bob's"])
+
+    def test_flat_container_falls_back_to_expat(self):
+        """Flat containers the scanner declines are still filtered by expat"""
+        from unittest import mock
+        import xml_builders
+        xml_input = b'<MediaContainer size="2"><Video ratingKey = "9"/><Video ratingKey="1"/></MediaContainer>'
+        with mock.patch.object(
+            xml_builders, '_filter_media_container_expat',
+            wraps=xml_builders._filter_media_container_expat,
+        ) as expat_filter:
+            result = filter_media_container_xml(xml_input, {'1'})
+        if not xml_builders.USE_PURE_PYTHON_FILTER:
+            expat_filter.assert_called_once()
+        root = ET.fromstring(result)
+        self.assertEqual(root.get('size'), '1')
+        self.assertEqual([child.get('ratingKey') for child in root], ['1'])
+
+    def test_allowlist_edited_in_place_is_reencoded(self):
+        """A mutable allowlist changed at the same size filters with its new keys"""
+        xml_input = b'<MediaContainer size="2"><Video ratingKey="1"/><Video ratingKey="2"/></MediaContainer>'
+        allowed = {'1'}
+        filter_media_container_xml(xml_input, allowed)
+        allowed.discard('1')
+        allowed.add('2')
+        root = ET.fromstring(filter_media_container_xml(xml_input, allowed))
+        self.assertEqual([child.get('ratingKey') for child in root], ['2'])
+
+    def test_with_counts_reports_items(self):
+        """The counting variant reports items before and after filtering"""
+        from xml_builders import filter_media_container_xml_with_counts
+        xml_input = (
+            b'<MediaContainer size="3"><Video ratingKey="100"/><Video ratingKey="200"/>'
+            b'<Hub title="keep"/></MediaContainer>'
+        )
+        result, original, filtered = filter_media_container_xml_with_counts(xml_input, {'100'})
+        self.assertEqual(result, filter_media_container_xml(xml_input, {'100'}))
+        self.assertEqual((original, filtered), (2, 1))
+
+        malformed = b'<MediaContainer><Video'
+        self.assertEqual(
+            filter_media_container_xml_with_counts(malformed, {'100'}), (malformed, -1, -1)
+        )
+
     def test_resets_offset(self):
         """Should reset offset to 0 for filtered results"""
         xml_input = b'''<?xml version="1.0" encoding="UTF-8"?>
@@ -235,6 +379,8 @@ class TestKometaConfigGeneration(unittest.TestCase):
     """Tests for kometa_run.yml generation."""
 
     def test_kometa_run_yaml_has_no_mid_doc_end_markers(self):
+        from config import generate_proxy_config
+
         with tempfile.TemporaryDirectory() as tmpdir:
             job_path = Path(tmpdir)
             (job_path / 'config').mkdir(parents=True, exist_ok=True)
@@ -262,6 +408,11 @@ class TestKometaConfigGeneration(unittest.TestCase):
                 if line.strip() == '...' and idx != last_non_empty:
                     self.fail("Found mid-document YAML end marker '...' in kometa_run.yml")
 
+    def test_sanitize_yaml_text_keeps_only_trailing_end_marker(self):
+        from config import sanitize_yaml_text
+        text = 'a: 1\n...\nb: 2\n...\n...\n\n'
+        self.assertEqual(sanitize_yaml_text(text), 'a: 1\nb: 2\n...\n\n')
+
 
 class TestIsListingEndpoint(unittest.TestCase):
     """Tests for is_listing_endpoint function"""
@@ -301,6 +452,12 @@ class TestIsListingEndpoint(unittest.TestCase):
         self.assertFalse(is_listing_endpoint('/'))
         self.assertFalse(is_listing_endpoint('/photo/:/transcode'))
 
+    def test_prefix_needs_word_boundary(self):
+        """A listing name must end at a path or query boundary"""
+        self.assertFalse(is_listing_endpoint('/library/sections/1/allItems'))
+        self.assertFalse(is_listing_endpoint('/library/searchable?x=/hubs/search'))
+        self.assertTrue(is_listing_endpoint('/library/sections/1/all/'))
+
 
 class TestExtractRatingKeyFromPath(unittest.TestCase):
     """Tests for extract_rating_key_from_path function"""
@@ -317,6 +474,11 @@ class TestExtractRatingKeyFromPath(unittest.TestCase):
         self.assertEqual(extract_rating_key_from_path('/library/metadata/12345/art'), '12345')
         self.assertEqual(extract_rating_key_from_path('/library/metadata/12345/poster'), '12345')
 
+    def test_transcoded_photo(self):
+        """Extract from the url parameter of a photo transcode"""
+        path = '/photo/:/transcode?width=300&url=%2Flibrary%2Fmetadata%2F12345%2Fthumb'
+        self.assertEqual(extract_rating_key_from_path(path), '12345')
+
     def test_no_rating_key(self):
         """Return None for paths without ratingKey"""
         self.assertIsNone(extract_rating_key_from_path('/library/sections/1/all'))
@@ -394,6 +556,15 @@ class TestExtractAllowedRatingKeys(unittest.TestCase):
         result = extract_allowed_rating_keys(config)
         self.assertEqual(result, {'12345'})
 
+    def test_returns_frozenset_from_preview_index(self):
+        """Allowed keys come from the PreviewIndex built for the same targets"""
+        from xml_builders import get_preview_index
+        targets = [{'id': 'matrix', 'ratingKey': '12345'}]
+        config = {'preview': {'targets': targets}}
+        result = extract_allowed_rating_keys(config)
+        self.assertIsInstance(result, frozenset)
+        self.assertEqual(result, get_preview_index(targets).allowed_rating_keys)
+
 
 class TestIntegration(unittest.TestCase):
     """Integration tests combining multiple functions"""
@@ -518,6 +689,17 @@ class TestBuildSyntheticLibrarySectionsXml(unittest.TestCase):
 class TestBuildSyntheticListingXml(unittest.TestCase):
     """Tests for build_synthetic_listing_xml function"""
 
+    def test_with_count_matches_built_xml(self):
+        """The counted variant should build the same document and report the item count"""
+        targets = [
+            {'type': 'movie', 'ratingKey': '100', 'title': 'Matrix'},
+            {'type': 'show', 'ratingKey': '200', 'title': 'Breaking Bad'},
+        ]
+        path = '/library/sections/1/all?includeMeta=1'
+        count, xml_bytes = build_synthetic_listing_xml_with_count(targets, path=path)
+        self.assertEqual(count, 2)
+        self.assertEqual(xml_bytes, build_synthetic_listing_xml(targets, path=path))
+
     def test_returns_only_allowlist_items(self):
         """Should return only items in targets"""
         targets = [
@@ -638,6 +820,17 @@ class TestBuildSyntheticListingXml(unittest.TestCase):
         self.assertEqual(root.get('size'), '0')
         self.assertEqual(len(list(root)), 0)
 
+    def test_empty_result_keeps_container_attributes(self):
+        """Precomputed empty listing carries the same attributes as a built one"""
+        targets = [
+            {'id': 'matrix', 'type': 'movie', 'ratingKey': '100', 'title': 'Matrix'},
+        ]
+        empty = ET.fromstring(build_synthetic_listing_xml(targets, query='Inception'))
+        full = ET.fromstring(build_synthetic_listing_xml(targets))
+        self.assertEqual(set(empty.attrib), set(full.attrib))
+        self.assertEqual(empty.get('totalSize'), '0')
+        self.assertEqual(empty.get('offset'), '0')
+
     def test_skips_targets_without_rating_key(self):
         """Should skip targets without ratingKey"""
         targets = [
@@ -743,6 +936,27 @@ class TestBuildSyntheticChildrenXml(unittest.TestCase):
 
         self.assertEqual(root.get('size'), '1')
 
+    def test_preview_index_candidates(self):
+        """Index narrows children to declared descendants plus unresolved targets"""
+        from xml_builders import build_preview_index
+        targets = [
+            {'type': 'show', 'ratingKey': '100'},
+            {'type': 'episode', 'ratingKey': '300', 'parentRatingKey': '200', 'grandparentRatingKey': '100'},
+            {'type': 'episode', 'ratingKey': '400', 'parentRatingKey': '500', 'grandparentRatingKey': '600'},
+        ]
+        index = build_preview_index(targets)
+        self.assertEqual(index.child_candidates('100'), [0, 1])
+        self.assertEqual(index.child_candidates('600'), [0, 2])
+        self.assertEqual(index.child_candidates('999'), [0])
+        self.assertTrue(index.has_shows)
+        self.assertFalse(index.has_movies)
+        self.assertEqual(index.keys[1].rating_key, '300')
+        self.assertEqual(index.keys[1].parent, '200')
+        self.assertEqual(index.keys[0].grandparent, '')
+        self.assertEqual(index.keys[1].type, 'episode')
+        self.assertIsNone(build_preview_index([{'ratingKey': '1'}]).keys[0].type)
+        self.assertEqual(build_preview_index([{'type': 'Movie'}]).keys[0].type, 'movie')
+
 
 class TestIsLibrarySectionsEndpoint(unittest.TestCase):
     """Tests for is_library_sections_endpoint function"""
@@ -834,6 +1048,25 @@ class TestExtractPreviewTargets(unittest.TestCase):
         self.assertEqual(extract_preview_targets({}), [])
         self.assertEqual(extract_preview_targets({'preview': {}}), [])
 
+    def test_prepared_targets_carry_their_index(self):
+        """Prepared lists keep the index built from them; other lists are indexed fresh"""
+        from xml_builders import get_preview_index, prepare_preview_targets
+        prepared = prepare_preview_targets([{'ratingKey': '100', 'type': 'movie'}])
+        self.assertIs(get_preview_index(prepared), get_preview_index(prepared))
+        self.assertEqual(get_preview_index(prepared).allowed_rating_keys, {'100'})
+
+        targets = [{'ratingKey': '100'}]
+        get_preview_index(targets)
+        targets[0] = {'ratingKey': '200'}
+        self.assertEqual(get_preview_index(targets).keys[0].rating_key, '200')
+
+    def test_precomputes_lowercase_title_on_copies(self):
+        """Targets get a pre-lowered title without mutating the config"""
+        raw = {'id': 'matrix', 'ratingKey': '100', 'title': 'The MATRIX'}
+        result = extract_preview_targets({'preview': {'targets': [raw]}})
+        self.assertEqual(result[0]['_title_lc'], 'the matrix')
+        self.assertNotIn('_title_lc', raw)
+
 
 class TestMockModeIntegration(unittest.TestCase):
     """Integration tests for mock library mode"""
@@ -948,6 +1181,30 @@ class TestCacheMetadataValidation(unittest.TestCase):
         # Should have correct size
         self.assertEqual(root.get('size'), '1')
 
+    def test_proxy_scan_finds_item(self):
+        """Proxy metadata scan returns the root tag and item attributes"""
+        import proxy_plex
+        root_tag, attrs = proxy_plex._scan_metadata_item(self._create_valid_xml(), '12345')
+        self.assertEqual(root_tag, 'MediaContainer')
+        self.assertEqual(attrs['title'], 'Test Movie')
+
+        # Falls back to the first child when no ratingKey matches
+        _, attrs = proxy_plex._scan_metadata_item(self._create_valid_xml(), '999')
+        self.assertEqual(attrs['ratingKey'], '12345')
+
+        root_tag, attrs = proxy_plex._scan_metadata_item(b'<Error code="1"/>', '12345')
+        self.assertEqual((root_tag, attrs), ('Error', None))
+
+        with self.assertRaises(proxy_plex._METADATA_PARSE_ERRORS):
+            proxy_plex._scan_metadata_item(b'<MediaContainer><Video', '12345')
+
+    def test_proxy_scan_stops_at_matching_item(self):
+        """Content after the matching item is not parsed"""
+        import proxy_plex
+        body = b'<MediaContainer size="1"><Video ratingKey="1" title="A">' + b' ' * 40000 + b'<Bro'
+        _, attrs = proxy_plex._scan_metadata_item(body, '1')
+        self.assertEqual(attrs['title'], 'A')
+
     def test_invalid_xml_detection(self):
         """Non-XML content should be detected"""
         invalid_content = b'this is not xml at all'
@@ -1039,6 +1296,19 @@ class TestCacheMetadataValidation(unittest.TestCase):
         # Starts with '<' but is HTML not MediaContainer XML
         self.assertTrue(html_response.strip().startswith(b'<'))
 
+    def test_proxy_sniffs_content_kind(self):
+        """Proxy sniffing classifies bodies from a bounded prefix"""
+        import gzip
+        from proxy_plex import _sniff_content_kind
+        valid_xml = self._create_valid_xml()
+        self.assertEqual(_sniff_content_kind(valid_xml), 'xml')
+        self.assertEqual(_sniff_content_kind(b'\n  ' + valid_xml), 'xml')
+        self.assertEqual(_sniff_content_kind(b' ' * 1000 + valid_xml), 'xml')
+        self.assertEqual(_sniff_content_kind(gzip.compress(valid_xml)), 'gzip')
+        self.assertEqual(_sniff_content_kind(b'<!DOCTYPE html><html></html>'), 'html')
+        self.assertEqual(_sniff_content_kind(b'this is not xml at all'), 'other')
+        self.assertEqual(_sniff_content_kind(b'   '), 'other')
+
     def test_truncated_xml_detection(self):
         """Truncated XML should raise parse error"""
         truncated_xml = b'''<?xml version="1.0" encoding="UTF-8"?>
@@ -1088,6 +1358,21 @@ class TestDecompressionHandling(unittest.TestCase):
 
         self.assertEqual(decompressed, original)
 
+    def test_proxy_decompress_helpers(self):
+        """Proxy helpers decompress with and without libdeflate"""
+        import gzip
+        import zlib
+        from unittest import mock
+        import proxy_plex
+
+        original = b'<MediaContainer size="0" />' * 50
+        gzipped = gzip.compress(original)
+        with mock.patch.object(proxy_plex, '_deflate', None):
+            self.assertEqual(proxy_plex._decompress_gzip(gzipped), original)
+        self.assertEqual(proxy_plex._decompress_gzip(gzipped), original)
+        self.assertEqual(proxy_plex._decompress_gzip(gzipped + gzip.compress(b'x')), original + b'x')
+        self.assertEqual(proxy_plex._decompress_deflate(zlib.compress(original)), original)
+
     def test_gzip_magic_bytes(self):
         """Gzip content should have correct magic bytes"""
         import gzip
@@ -1142,6 +1427,34 @@ class TestDecompressionHandling(unittest.TestCase):
 class TestTMDbRequestFingerprint(unittest.TestCase):
     """Tests for TMDb request fingerprinting (G1)"""
 
+    def test_proxy_fingerprint_ignores_param_order(self):
+        """Memoized proxy fingerprint is order-independent and counts hits"""
+        from proxy_tmdb import compute_request_fingerprint
+        fp1 = compute_request_fingerprint('GET', '/3/discover/movie?page=1&sort_by=popularity.desc')
+        before = compute_request_fingerprint.cache_info().hits
+        fp2 = compute_request_fingerprint('GET', '/3/discover/movie?sort_by=popularity.desc&page=1')
+        fp3 = compute_request_fingerprint('GET', '/3/discover/movie?page=1&sort_by=popularity.desc')
+        self.assertEqual(fp1, fp2)
+        self.assertEqual(fp1, fp3)
+        self.assertEqual(len(fp1), 32)
+        self.assertEqual(compute_request_fingerprint.cache_info().hits, before + 1)
+
+    def test_proxy_fingerprint_field_boundaries(self):
+        """Shifting text between path, keys and values changes the fingerprint"""
+        from proxy_tmdb import compute_request_fingerprint
+        paths = [
+            '/3/discover/movie?ab=c',
+            '/3/discover/movie?a=bc',
+            '/3/discover/movie?a=b&a=c',
+            '/3/discover/moviea?b=c',
+        ]
+        fingerprints = {compute_request_fingerprint('GET', p) for p in paths}
+        self.assertEqual(len(fingerprints), len(paths))
+        self.assertNotEqual(
+            compute_request_fingerprint('GET', paths[0]),
+            compute_request_fingerprint('POST', paths[0]),
+        )
+
     def test_fingerprint_stability(self):
         """Same request should produce same fingerprint"""
         import hashlib
@@ -1226,6 +1539,40 @@ class TestNonOverlayDiscoverDetection(unittest.TestCase):
 
         return False
 
+    def test_proxy_handler_matches_reference(self):
+        """TMDbProxyHandler agrees with the reference detection above"""
+        from proxy_tmdb import TMDbProxyHandler
+        handler = TMDbProxyHandler.__new__(TMDbProxyHandler)
+        paths = [
+            '/3/discover/movie?api_key=xxx&with_genres=28',
+            '/3/discover/tv?with_networks=&sort_by=popularity.desc',
+            '/3/discover/movie?vote_count.gte=500',
+            '/3/discover/movie?vote_count.gte=abc',
+            '/3/discover/movie',
+            '/3/discover/movie?page',
+            '/3/discover/movie?with_genres=#',
+            '/3/discover/movie?vote_count.gte=50#0',
+            '/3/movie/603?with_genres=28',
+        ]
+        for path in paths:
+            self.assertEqual(handler._is_non_overlay_discover(path), self._is_non_overlay_discover(path), path)
+
+    def test_scan_query_matches_parse_qs(self):
+        """Proxy query scan returns parse_qs's first value for requested keys"""
+        from urllib.parse import parse_qs
+        from proxy_tmdb import _scan_query
+        keys = frozenset({'with_genres', 'vote_count.gte', 'a b'})
+        queries = [
+            'with_genres=&with_genres=28&page=1',
+            'with%5Fgenres=12%2C16',
+            'a+b=c+d&vote_count.gte=100&vote_count.gte=5',
+            'page&sort_by=popularity.desc',
+            '',
+        ]
+        for query in queries:
+            expected = {k: v[0] for k, v in parse_qs(query).items() if k in keys}
+            self.assertEqual(_scan_query(query, keys), expected, query)
+
     def test_genre_collection_is_non_overlay(self):
         """Genre-based discover is non-overlay (collection builder)"""
         path = '/3/discover/movie?api_key=xxx&with_genres=28'
@@ -1379,6 +1726,20 @@ class TestTVDbConversionDetection(unittest.TestCase):
 
         return False
 
+    def test_proxy_handler_matches_reference(self):
+        """TMDbProxyHandler agrees with the reference detection above"""
+        from proxy_tmdb import TMDbProxyHandler
+        handler = TMDbProxyHandler.__new__(TMDbProxyHandler)
+        paths = [
+            '/3/tv/1399/external_ids?api_key=xxx',
+            '/3/find/81189?external_source=tvdb_id',
+            '/3/find/tt0903747?external_source=imdb_id',
+            '/3/find/81189',
+            '/3/movie/603',
+        ]
+        for path in paths:
+            self.assertEqual(handler._is_tvdb_conversion_request(path), self._is_tvdb_conversion_request(path), path)
+
     def test_tv_external_ids_detected(self):
         """TV show external_ids endpoint should be detected"""
         path = '/3/tv/12345/external_ids?api_key=xxx'
@@ -1492,10 +1853,40 @@ class TestLibrarySectionType(unittest.TestCase):
         self.assertIsNotNone(directory)
         self.assertEqual(directory.get('type'), 'movie')
 
+    def test_logged_type_read_without_parsing(self):
+        """Proxy log pattern reads the same type the parsed document has"""
+        from constants import MOCK_DIRECTORY_TYPE_PATTERN
+        for section_id, expected in (('1', b'movie'), ('2', b'show')):
+            xml_bytes = build_synthetic_section_detail_xml(section_id, [])
+            self.assertEqual(MOCK_DIRECTORY_TYPE_PATTERN.search(xml_bytes).group(1), expected)
+
+    def test_rendered_once_per_section_and_type(self):
+        """Repeated requests reuse the document until the section type changes"""
+        first = build_synthetic_section_detail_xml('3', [{'type': 'movie'}])
+        self.assertIs(build_synthetic_section_detail_xml('3', [{'type': 'movie'}]), first)
+        shows = build_synthetic_section_detail_xml('3', [{'type': 'show'}])
+        self.assertEqual(ET.fromstring(shows).find('Directory').get('type'), 'show')
+
+    def test_collections_rendered_once_per_meta_variant(self):
+        """Collections documents are reused per section and includeMeta flag"""
+        from xml_builders import build_synthetic_collections_xml
+        path = '/library/sections/1/collections'
+        plain = build_synthetic_collections_xml('1', path=path)
+        self.assertIs(build_synthetic_collections_xml('1', path=path), plain)
+        meta = build_synthetic_collections_xml('1', path=path + '?includeMeta=1')
+        self.assertIsNotNone(ET.fromstring(meta).find('Meta'))
+        self.assertIsNone(ET.fromstring(plain).find('Meta'))
+
 
 class TestFilterTypesEndpoint(unittest.TestCase):
     """Tests for synthetic filterTypes endpoint - P0 fix for plex_search validation"""
 
+    def test_rendered_once_per_variant(self):
+        """Repeated requests for the same libtypes reuse the rendered document"""
+        first = build_synthetic_filter_types_xml('1', [{'type': 'movie'}])
+        self.assertIs(build_synthetic_filter_types_xml('1', [{'type': 'movie'}]), first)
+        self.assertIsNot(build_synthetic_filter_types_xml('2', [{'type': 'show'}]), first)
+
     def test_is_filter_types_endpoint_matches(self):
         """filterTypes endpoint pattern should match correctly"""
         self.assertEqual(is_filter_types_endpoint('/library/sections/1/filterTypes'), '1')
@@ -1609,12 +2000,43 @@ class TestUploadCaptureParsing(unittest.TestCase):
         self.assertEqual(image_bytes, jpeg_bytes)
         self.assertEqual(ext, 'jpg')
 
+    def test_multipart_fast_path_matches_email_parser(self):
+        """Byte-level multipart scan agrees with the email parser fallback"""
+        from unittest import mock
+        import xml_builders
+        png_bytes = b'\x89PNG\r\n\x1a\n' + b'\r\n--not-a-boundary' + b'\x00' * 20
+        boundary = 'xyz'
+        body = (
+            f'--{boundary}\r\n'
+            'Content-Disposition: form-data; name="title"\r\n\r\n'
+            'poster\r\n'
+            f'--{boundary}\r\n'
+            'Content-Disposition: form-data; name="file"; filename="poster.PNG"\r\n\r\n'
+        ).encode() + png_bytes + f'\r\n--{boundary}--\r\n'.encode()
+        content_type = f'multipart/form-data; boundary="{boundary}"'
+
+        fast = xml_builders.parse_multipart_image(body, content_type)
+        with mock.patch.object(xml_builders, '_scan_multipart_image', return_value=None):
+            fallback = xml_builders.parse_multipart_image(body, content_type)
+        self.assertEqual(fast, (png_bytes, 'png'))
+        self.assertEqual(fast, fallback)
+
+        # Encoded parts are left to the email parser
+        encoded = body.replace(b'filename="poster.PNG"\r\n', b'filename="poster.PNG"\r\nContent-Transfer-Encoding: base64\r\n')
+        self.assertIsNone(xml_builders._scan_multipart_image(encoded, boundary))
+
+        # So are parts whose header block is implausibly long
+        padded = body.replace(b'name="title"\r\n', b'name="title"\r\nX-Pad: ' + b'a' * 9000 + b'\r\n')
+        self.assertIsNone(xml_builders._scan_multipart_image(padded, boundary))
+
 
 class TestFastModeSanitization(unittest.TestCase):
     """Tests for FAST mode sanitization"""
 
     def test_letterboxd_removed_and_imdb_filter_stripped(self):
         """Letterboxd entries removed, IMDb category_filter stripped"""
+        from sanitization import sanitize_overlay_data_for_fast_mode
+
         data = {
             'overlays': {
                 'LetterboxdOverlay': {
@@ -1641,6 +2063,7 @@ class TestFastModeTmdbCapping(unittest.TestCase):
     def test_discover_capped(self):
         """Discover responses should be capped to id_limit"""
         import json
+        from proxy_tmdb import TMDbProxyHandler
 
         handler = TMDbProxyHandler.__new__(TMDbProxyHandler)
         handler.id_limit = 2
@@ -1660,15 +2083,133 @@ class TestFastModeTmdbCapping(unittest.TestCase):
         }
         body = json.dumps(response).encode('utf-8')
 
-        capped_body, was_capped = TMDbProxyHandler._cap_tmdb_response(
+        capped_body, was_capped, original_total, capped_count = TMDbProxyHandler._cap_tmdb_response(
             handler, body, '/3/discover/movie'
         )
         self.assertTrue(was_capped)
+        self.assertEqual((original_total, capped_count), (5, 2))
         capped = json.loads(capped_body)
         self.assertEqual(len(capped['results']), 2)
         self.assertEqual(capped['total_pages'], 1)
 
 
+class TestMockGetRouting(unittest.TestCase):
+    """Tests for the mock-mode GET route table"""
+
+    def _route(self, path):
+        from proxy_plex import PlexProxyHandler
+        handler = PlexProxyHandler.__new__(PlexProxyHandler)
+        route = handler._match_mock_get_route(path)
+        return (route[0], route[2]) if route else None
+
+    def test_routes_in_priority_order(self):
+        """Specific section sub-paths win over section detail"""
+        self.assertEqual(self._route('/library/sections'), ('sections', True))
+        self.assertEqual(self._route('/library/sections/1/filterTypes'), ('filter_types', '1'))
+        self.assertEqual(self._route('/library/sections/2/collections'), ('collections', '2'))
+        self.assertEqual(self._route('/library/sections/2'), ('section_detail', '2'))
+        self.assertEqual(self._route('/library/sections/1/all?type=1')[0], 'listing')
+        self.assertEqual(self._route('/library/metadata/5/children'), ('children', '5'))
+
+    def test_unmatched_path_forwards(self):
+        """Paths without a mock handler return None"""
+        self.assertIsNone(self._route('/library/metadata/5'))
+
+
+class TestListingXmlCache(unittest.TestCase):
+    """Tests for the rendered mock listing cache"""
+
+    def test_stores_rendered_listing(self):
+        """The rendered document is cached with its item count"""
+        from proxy_plex import PlexProxyHandler
+        saved = PlexProxyHandler.listing_xml_cache
+        PlexProxyHandler.listing_xml_cache = {}
+        try:
+            handler = PlexProxyHandler.__new__(PlexProxyHandler)
+            key = ('1', None, False, 0)
+            handler._store_rendered_xml(PlexProxyHandler.listing_xml_cache, key, 1, b'<a></a>')
+            self.assertEqual(PlexProxyHandler.listing_xml_cache[key], (1, b'<a></a>'))
+        finally:
+            PlexProxyHandler.listing_xml_cache = saved
+
+    def test_listing_sent_with_length_on_miss_and_hit(self):
+        """Both rendered and cached listings go out as complete byte bodies"""
+        from unittest import mock
+        from proxy_plex import PlexProxyHandler
+        from xml_builders import build_synthetic_listing_xml_with_count
+        saved = (PlexProxyHandler.listing_xml_cache, PlexProxyHandler.mock_list_requests)
+        PlexProxyHandler.listing_xml_cache = {}
+        PlexProxyHandler.mock_list_requests = []
+        try:
+            handler = PlexProxyHandler.__new__(PlexProxyHandler)
+            handler.preview_targets = [{'ratingKey': '100', 'type': 'movie', 'title': 'Movie'}]
+            handler.metadata_cache = {}
+            handler.metadata_cache_version = 0
+            sent = []
+            handler._send_xml_response = sent.append
+            with mock.patch(
+                'proxy_plex.build_synthetic_listing_xml_with_count',
+                wraps=build_synthetic_listing_xml_with_count
+            ) as render:
+                handler._handle_mock_listing('/library/sections/1/all')
+                handler._handle_mock_listing('/library/sections/1/all')
+            self.assertEqual(render.call_count, 1)
+            self.assertIsInstance(sent[0], bytes)
+            self.assertIs(sent[1], sent[0])
+            self.assertEqual(ET.fromstring(sent[0]).find('Video').get('ratingKey'), '100')
+        finally:
+            PlexProxyHandler.listing_xml_cache, PlexProxyHandler.mock_list_requests = saved
+
+    def test_children_rendered_once_per_cache_version(self):
+        """Repeated children requests reuse the rendered document"""
+        from unittest import mock
+        from proxy_plex import PlexProxyHandler
+        from xml_builders import build_synthetic_children_xml_with_count
+        saved = (PlexProxyHandler.children_xml_cache, PlexProxyHandler.mock_list_requests)
+        PlexProxyHandler.children_xml_cache = {}
+        PlexProxyHandler.mock_list_requests = []
+        try:
+            handler = PlexProxyHandler.__new__(PlexProxyHandler)
+            handler.preview_targets = [
+                {'ratingKey': '201', 'type': 'season', 'parentRatingKey': '200', 'title': 'Season 1'},
+            ]
+            handler.metadata_cache = {}
+            handler.metadata_cache_version = 0
+            sent = []
+            handler._send_xml_response = sent.append
+            with mock.patch(
+                'proxy_plex.build_synthetic_children_xml_with_count',
+                wraps=build_synthetic_children_xml_with_count
+            ) as render:
+                handler._handle_mock_children('200')
+                handler._handle_mock_children('200')
+                self.assertEqual(render.call_count, 1)
+                handler.metadata_cache_version = 1
+                handler._handle_mock_children('200')
+                self.assertEqual(render.call_count, 2)
+            self.assertEqual(sent[0], sent[1])
+            self.assertEqual(len(ET.fromstring(sent[0]).findall('Directory')), 1)
+        finally:
+            PlexProxyHandler.children_xml_cache, PlexProxyHandler.mock_list_requests = saved
+
+
+class TestValidateLibrarySections(unittest.TestCase):
+    """Tests for validate_library_sections"""
+
+    def test_validates_selected_libraries(self):
+        """Selected libraries must exist with the expected type"""
+        from config import validate_library_sections
+        sections_xml = build_synthetic_library_sections_xml([])
+        validate_library_sections(sections_xml, ['Movies'], 'movie')
+        validate_library_sections(sections_xml, ['TV Shows'], None)
+        with self.assertRaises(RuntimeError):
+            validate_library_sections(sections_xml, ['TV Shows'], 'movie')
+        with self.assertRaises(RuntimeError):
+            validate_library_sections(sections_xml, ['Anime'], None)
+        with self.assertRaises(RuntimeError):
+            validate_library_sections(b'<MediaContainer size="0" />', ['Movies'], None)
+
+
 class TestSafePreviewTargets(unittest.TestCase):
     """Tests for safe preview target extraction"""
 
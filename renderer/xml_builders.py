@@ -5,22 +5,46 @@ This module provides functions for building synthetic Plex XML responses
 and filtering XML responses based on allowed rating keys.
 """
 
-import re
+import sys
 import xml.etree.ElementTree as ET
-from typing import Any, Dict, List, Optional, Set
-from urllib.parse import urlsplit, parse_qs
+from dataclasses import dataclass, field
+from email.feedparser import BytesFeedParser
+from email.policy import default as email_policy
+from xml.parsers import expat
+from xml.sax.saxutils import escape
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple
+from urllib.parse import unquote_plus
+
+try:
+    # lxml builds and serializes elements in C; the synthetic builders only
+    # use the API subset it shares with ElementTree
+    from lxml import etree as _LET
+except ImportError:
+    _LET = ET
+
+if _LET is not ET:
+    # Shared by the filter fallback; entity expansion, network access and the
+    # xml:id index are all off
+    _FILTER_PARSER = _LET.XMLParser(
+        resolve_entities=False, no_network=True, huge_tree=False, collect_ids=False
+    )
+    _FILTER_PARSE_ERRORS: Tuple[type, ...] = (ET.ParseError, _LET.XMLSyntaxError)
+else:
+    _FILTER_PARSER = None
+    _FILTER_PARSE_ERRORS = (ET.ParseError,)
 
 from constants import (
     logger,
-    LIBRARY_LISTING_PATTERNS,
+    LIBRARY_LISTING_PATTERN,
     METADATA_PATTERN,
     ARTWORK_PATTERNS,
     PLEX_UPLOAD_PATTERN,
-    LIBRARY_SECTIONS_PATTERN,
     LIBRARY_SECTION_DETAIL_PATTERN,
     SECTION_ID_PATTERN,
     CHILDREN_PATTERN,
     LIBRARY_FILTER_TYPES_PATTERN,
+    LIBRARY_COLLECTIONS_PATTERN,
+    MULTIPART_BOUNDARY_PATTERN,
 )
 
 
@@ -28,6 +52,415 @@ from constants import (
 # XML Filtering Helpers (Unit-Testable)
 # ============================================================================
 
+# PyPy's JIT handles a plain bytes-scanning loop better than calls into expat
+USE_PURE_PYTHON_FILTER = sys.implementation.name == 'pypy'
+
+# Single-byte slices that may precede an attribute name inside a start tag
+_XML_SPACE_BYTES = frozenset({b' ', b'\t', b'\r', b'\n'})
+
+_XML_ATTRIB_ENTITIES = {'"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#09;'}
+
+
+def _escape_xml_attrib(value: str) -> str:
+    """Escape an attribute value the same way ElementTree serializes it."""
+    return escape(value, _XML_ATTRIB_ENTITIES)
+
+
+def _filter_media_container_expat(
+    xml_bytes: bytes,
+    allowed_rating_keys: Set[str]
+) -> Optional[Tuple[bytes, int, int]]:
+    """
+    Filter top-level items by splicing byte ranges located with expat.
+
+    No Element objects are created: allowed items are copied straight from the
+    input and only the root start tag is re-serialized. Each removed item's
+    range runs from its start tag to the next markup event, so its tail text
+    goes with it (matching ElementTree's remove()).
+
+    Returns:
+        Tuple of (filtered_bytes, original_count, filtered_count), or None if
+        the document shape isn't handled here (e.g. a self-closing root).
+
+    Raises:
+        expat.ExpatError: If the XML is malformed
+    """
+    parser = expat.ParserCreate()
+    parser.ordered_attributes = True
+
+    depth = 0
+    original_count = 0
+    filtered_count = 0
+    root_tag: Optional[str] = None
+    root_attrs: List[str] = []
+    root_start = -1
+    root_tag_end = -1
+    removal_start = -1
+    removal_closed = False
+    removals: List[Tuple[int, int]] = []
+
+    def mark_boundary(is_text: bool = False):
+        nonlocal root_tag_end, removal_start, removal_closed
+        index = parser.CurrentByteIndex
+        if root_tag_end < 0 and root_start >= 0:
+            root_tag_end = index
+            # Text events only matter for locating the root tag's end; the
+            # indentation between items no longer needs a Python callback
+            parser.CharacterDataHandler = None
+        # Text after a removed item is its tail and goes with it
+        if removal_closed and not is_text:
+            removals.append((removal_start, index))
+            removal_start = -1
+            removal_closed = False
+
+    def on_start(name, attrs):
+        nonlocal depth, root_tag, root_attrs, root_start, removal_start
+        nonlocal original_count, filtered_count
+        mark_boundary()
+        depth += 1
+        if depth == 1:
+            root_tag = name
+            root_attrs = attrs
+            root_start = parser.CurrentByteIndex
+        elif depth == 2:
+            # attrs is a flat [name, value, name, value, ...] list
+            for i in range(0, len(attrs), 2):
+                if attrs[i] == 'ratingKey':
+                    original_count += 1
+                    if attrs[i + 1] in allowed_rating_keys:
+                        filtered_count += 1
+                    else:
+                        removal_start = parser.CurrentByteIndex
+                    break
+
+    def on_end(name):
+        nonlocal depth, removal_closed
+        mark_boundary()
+        if depth == 2 and removal_start >= 0:
+            removal_closed = True
+        depth -= 1
+
+    def on_text(data):
+        mark_boundary(is_text=True)
+
+    def on_other(*args):
+        mark_boundary()
+
+    parser.StartElementHandler = on_start
+    parser.EndElementHandler = on_end
+    parser.CharacterDataHandler = on_text
+    parser.CommentHandler = on_other
+    parser.ProcessingInstructionHandler = on_other
+    parser.Parse(xml_bytes, True)
+
+    if root_tag is None or root_tag_end <= root_start:
+        return None
+
+    attrs = dict(zip(root_attrs[::2], root_attrs[1::2]))
+    if root_tag == 'MediaContainer':
+        attrs['size'] = str(filtered_count)
+        if 'totalSize' in attrs:
+            attrs['totalSize'] = str(filtered_count)
+        if 'offset' in attrs:
+            attrs['offset'] = '0'
+
+    if not removals and attrs == dict(zip(root_attrs[::2], root_attrs[1::2])):
+        return xml_bytes, original_count, filtered_count
+
+    attr_text = ''.join(f' {key}="{_escape_xml_attrib(value)}"' for key, value in attrs.items())
+    parts = [xml_bytes[:root_start], f'<{root_tag}{attr_text}>'.encode('utf-8')]
+    position = root_tag_end
+    for range_start, range_end in removals:
+        parts.append(xml_bytes[position:range_start])
+        position = range_end
+    parts.append(xml_bytes[position:])
+    return b''.join(parts), original_count, filtered_count
+
+
+def _set_tag_attrib(tag: bytes, name: bytes, value: bytes, add: bool) -> Optional[bytes]:
+    """
+    Replace a double-quoted attribute value inside a raw start tag.
+
+    Returns the updated tag, or None if the attribute is present in a form
+    this simple scanner doesn't handle (e.g. single-quoted).
+    """
+    needle = name + b'="'
+    index = tag.find(needle)
+    while index > 0 and tag[index - 1:index] not in _XML_SPACE_BYTES:
+        index = tag.find(needle, index + 1)
+    if index < 0:
+        if tag.find(name + b"='") >= 0:
+            return None
+        if not add:
+            return tag
+        close = len(tag) - 2 if tag.endswith(b'/>') else len(tag) - 1
+        return tag[:close] + b' ' + needle + value + b'"' + tag[close:]
+    value_start = index + len(needle)
+    value_end = tag.find(b'"', value_start)
+    return tag[:value_start] + value + tag[value_end:]
+
+
+def _find_tag_end(xml_bytes: bytes, lt: int) -> int:
+    """Return the index of the '>' closing the tag at lt, skipping quoted '>'."""
+    find = xml_bytes.find
+    pos = lt + 1
+    while True:
+        gt = find(b'>', pos)
+        if gt < 0:
+            return -1
+        quote_pos = _first_quote(xml_bytes, pos, gt)
+        if quote_pos < 0:
+            return gt
+        # Skip the whole value: a quote of the other kind inside it is text
+        close = find(xml_bytes[quote_pos:quote_pos + 1], quote_pos + 1)
+        if close < 0:
+            return -1
+        pos = close + 1
+
+
+def _first_quote(data: bytes, start: int, end: int) -> int:
+    """Return the index of the first '"' or "'" in data[start:end], or -1."""
+    double = data.find(b'"', start, end)
+    single = data.find(b"'", start, end)
+    if double < 0:
+        return single
+    if single < 0:
+        return double
+    return min(double, single)
+
+
+def _in_quoted_value(tag: bytes, index: int) -> bool:
+    """Return True if tag[index] lies inside a quoted attribute value."""
+    pos = 0
+    while True:
+        quote_pos = _first_quote(tag, pos, index)
+        if quote_pos < 0:
+            return False
+        close = tag.find(tag[quote_pos:quote_pos + 1], quote_pos + 1)
+        if close < 0 or close >= index:
+            return True
+        pos = close + 1
+
+
+# Single-slot cache for the proxy's allowlist. Only frozensets are cached:
+# they cannot change after being encoded, so identity is a safe key.
+_allowed_bytes_cache: Optional[Tuple[FrozenSet[str], FrozenSet[bytes]]] = None
+
+
+def _allowed_rating_keys_bytes(allowed_rating_keys: Set[str]) -> FrozenSet[bytes]:
+    """Return the UTF-8 encoded allowlist; mutable sets are encoded on every call."""
+    global _allowed_bytes_cache
+    if not isinstance(allowed_rating_keys, frozenset):
+        return frozenset(key.encode('utf-8') for key in allowed_rating_keys)
+    cached = _allowed_bytes_cache
+    if cached is not None and cached[0] is allowed_rating_keys:
+        return cached[1]
+    encoded = frozenset(key.encode('utf-8') for key in allowed_rating_keys)
+    _allowed_bytes_cache = (allowed_rating_keys, encoded)
+    return encoded
+
+
+def _filter_media_container_scan(
+    xml_bytes: bytes,
+    allowed_rating_keys: Set[str]
+) -> Optional[Tuple[bytes, int, int]]:
+    """
+    Filter top-level items with a pure-Python tag scanner.
+
+    Uses only bytes.find and slicing, so there is no C extension boundary in
+    the loop for a tracing JIT (PyPy) to stop at. Removed ranges match the
+    expat path: from an item's start tag to the next '<' after it closes.
+
+    Returns:
+        Tuple of (filtered_bytes, original_count, filtered_count), or None for
+        constructs the scanner doesn't handle (CDATA, DOCTYPE, entity-encoded
+        rating keys, ratingKey attributes not written as ratingKey="...",
+        single-quoted container attributes).
+    """
+    find = xml_bytes.find
+    # Raw attribute slices are compared without decoding each one
+    allowed_bytes = _allowed_rating_keys_bytes(allowed_rating_keys)
+    depth = 0
+    original_count = 0
+    filtered_count = 0
+    root_tag = b''
+    root_start = -1
+    root_tag_end = -1
+    removal_start = -1
+    removals: List[Tuple[int, int]] = []
+    pos = 0
+
+    while True:
+        lt = find(b'<', pos)
+        if lt < 0:
+            break
+        if removal_start >= 0 and depth == 1:
+            # First markup after a removed item closes its range (tail included)
+            removals.append((removal_start, lt))
+            removal_start = -1
+
+        marker = xml_bytes[lt + 1:lt + 2]
+        if marker == b'?':
+            end = find(b'?>', lt)
+            if end < 0:
+                return None
+            pos = end + 2
+            continue
+        if marker == b'!':
+            if not xml_bytes.startswith(b'<!--', lt):
+                return None
+            end = find(b'-->', lt)
+            if end < 0:
+                return None
+            pos = end + 3
+            continue
+
+        gt = _find_tag_end(xml_bytes, lt)
+        if gt < 0:
+            return None
+        pos = gt + 1
+
+        if marker == b'/':
+            depth -= 1
+            if depth < 0:
+                return None
+            if depth == 0:
+                break
+            continue
+
+        self_closing = xml_bytes[gt - 1:gt] == b'/'
+        if depth == 0:
+            # Root attributes are rewritten by plain find(); single quotes
+            # could hide a size="..." inside another value
+            if self_closing or b"'" in xml_bytes[lt:pos]:
+                return None
+            root_start = lt
+            root_tag_end = pos
+            root_tag = xml_bytes[lt:pos]
+        elif depth == 1:
+            tag = xml_bytes[lt:pos]
+            index = tag.find(b'ratingKey')
+            if index >= 0:
+                # Only the plain ' ratingKey="..."' spelling is scanned. Any other
+                # mention of the name (spaces around '=', single quotes, a second
+                # occurrence) goes to expat rather than risk keeping the item.
+                if (
+                    tag[index - 1:index] not in _XML_SPACE_BYTES
+                    or not tag.startswith(b'ratingKey="', index)
+                    or tag.find(b'ratingKey', index + 1) >= 0
+                    or _in_quoted_value(tag, index)
+                ):
+                    return None
+                value_start = index + 11
+                value = tag[value_start:tag.find(b'"', value_start)]
+                if b'&' in value:
+                    return None
+                original_count += 1
+                if value in allowed_bytes:
+                    filtered_count += 1
+                else:
+                    removal_start = lt
+        if not self_closing:
+            depth += 1
+
+    if root_start < 0 or depth != 0:
+        return None
+
+    new_root_tag = root_tag
+    if root_tag.startswith(b'<MediaContainer') and root_tag[15:16] in (b' ', b'\t', b'\r', b'\n', b'>'):
+        count = str(filtered_count).encode('ascii')
+        for name, value, add in ((b'size', count, True), (b'totalSize', count, False), (b'offset', b'0', False)):
+            new_root_tag = _set_tag_attrib(new_root_tag, name, value, add)
+            if new_root_tag is None:
+                return None
+
+    if not removals and new_root_tag == root_tag:
+        return xml_bytes, original_count, filtered_count
+
+    parts = [xml_bytes[:root_start], new_root_tag]
+    position = root_tag_end
+    for range_start, range_end in removals:
+        parts.append(xml_bytes[position:range_start])
+        position = range_end
+    parts.append(xml_bytes[position:])
+    return b''.join(parts), original_count, filtered_count
+
+
+def _utf8_xml_declaration(xml_bytes: bytes) -> bytes:
+    """Return the input's XML declaration if it is compatible with UTF-8 output, else b''."""
+    if not xml_bytes.startswith(b'<?xml'):
+        return b''
+    decl_end = xml_bytes.find(b'?>')
+    if decl_end < 0:
+        return b''
+    prolog = xml_bytes[:decl_end + 2]
+    lowered = prolog.lower()
+    if b'encoding' in lowered and b'utf-8' not in lowered:
+        return b''
+    return prolog
+
+
+def _filter_media_container_etree(
+    xml_bytes: bytes,
+    allowed_rating_keys: Set[str]
+) -> Tuple[bytes, int, int]:
+    """
+    Filter top-level items using a full tree parse and re-serialization.
+
+    Uses lxml when it is installed, ElementTree otherwise.
+
+    Returns:
+        Tuple of (filtered_bytes, original_count, filtered_count)
+    """
+    # Parse XML
+    if _FILTER_PARSER is not None:
+        root = _LET.fromstring(xml_bytes, parser=_FILTER_PARSER)
+    else:
+        root = ET.fromstring(xml_bytes)
+
+    # Track counts for logging
+    original_count = 0
+    filtered_count = 0
+
+    # Keep children without a ratingKey and those that are allowed, counting
+    # as we go. Common element types: Video, Directory, Track, Photo, Episode,
+    # Season, Show
+    kept_children = []
+    for child in root:
+        rating_key = child.get('ratingKey')
+        if rating_key is not None:
+            original_count += 1
+            if rating_key not in allowed_rating_keys:
+                continue
+            filtered_count += 1
+        kept_children.append(child)
+
+    # One slice assignment instead of a linear-time remove() per dropped child;
+    # tails stay attached to their elements either way
+    if filtered_count != original_count:
+        root[:] = kept_children
+
+    # Update MediaContainer attributes
+    if root.tag == 'MediaContainer':
+        # Update size to reflect filtered count
+        root.set('size', str(filtered_count))
+
+        # If totalSize exists, update it too (for paginated responses)
+        if 'totalSize' in root.attrib:
+            root.set('totalSize', str(filtered_count))
+
+        # Reset offset if present (we're returning all filtered items)
+        if 'offset' in root.attrib:
+            root.set('offset', '0')
+
+    # Reuse the input's XML declaration instead of having ET regenerate one
+    body = _LET.tostring(root, encoding='utf-8', xml_declaration=False)
+    prolog = _utf8_xml_declaration(xml_bytes)
+    if prolog:
+        body = prolog + b'\n' + body
+    return body, original_count, filtered_count
+
+
 def filter_media_container_xml(xml_bytes: bytes, allowed_rating_keys: Set[str]) -> bytes:
     """
     Filter a Plex MediaContainer XML response to only include items with allowed ratingKeys.
@@ -45,44 +478,41 @@ def filter_media_container_xml(xml_bytes: bytes, allowed_rating_keys: Set[str])
     Returns:
         Filtered XML bytes with same structure but only allowed items
     """
-    try:
-        # Parse XML
-        root = ET.fromstring(xml_bytes)
-
-        # Track counts for logging
-        original_count = 0
-        filtered_count = 0
-
-        # Find all child elements that have ratingKey attribute
-        # Common element types: Video, Directory, Track, Photo, Episode, Season, Show
-        children_to_remove = []
-
-        for child in root:
-            # Check if this element has a ratingKey
-            rating_key = child.get('ratingKey')
-            if rating_key is not None:
-                original_count += 1
-                if rating_key not in allowed_rating_keys:
-                    children_to_remove.append(child)
-                else:
-                    filtered_count += 1
+    return filter_media_container_xml_with_counts(xml_bytes, allowed_rating_keys)[0]
 
-        # Remove non-allowed children
-        for child in children_to_remove:
-            root.remove(child)
 
-        # Update MediaContainer attributes
-        if root.tag == 'MediaContainer':
-            # Update size to reflect filtered count
-            root.set('size', str(filtered_count))
+def filter_media_container_xml_with_counts(
+    xml_bytes: bytes,
+    allowed_rating_keys: Set[str]
+) -> Tuple[bytes, int, int]:
+    """
+    Filter like filter_media_container_xml and also report the item counts.
 
-            # If totalSize exists, update it too (for paginated responses)
-            if 'totalSize' in root.attrib:
-                root.set('totalSize', str(filtered_count))
+    The byte-splicing paths are tried first: the pure-Python scanner on PyPy
+    and for flat containers, expat otherwise. The ElementTree path handles
+    the shapes they decline.
 
-            # Reset offset if present (we're returning all filtered items)
-            if 'offset' in root.attrib:
-                root.set('offset', '0')
+    Returns:
+        Tuple of (filtered_bytes, original_count, filtered_count). Both counts
+        are -1 when the body couldn't be filtered and is passed through.
+    """
+    try:
+        result = None
+        try:
+            # A flat container of self-closing items has the root's end tag as
+            # its only '</'; the scanner beats expat there even on CPython. It
+            # returns None for any item it can't read exactly (for example a
+            # ratingKey spelled with spaces around '='), and expat takes over.
+            if USE_PURE_PYTHON_FILTER or xml_bytes.count(b'</') <= 1:
+                result = _filter_media_container_scan(xml_bytes, allowed_rating_keys)
+            if result is None and not USE_PURE_PYTHON_FILTER:
+                result = _filter_media_container_expat(xml_bytes, allowed_rating_keys)
+        except (expat.ExpatError, UnicodeDecodeError):
+            # Let the ElementTree path report the parse error
+            result = None
+        if result is None:
+            result = _filter_media_container_etree(xml_bytes, allowed_rating_keys)
+        filtered_bytes, original_count, filtered_count = result
 
         # Log the filtering
         removed_count = original_count - filtered_count
@@ -92,15 +522,14 @@ def filter_media_container_xml(xml_bytes: bytes, allowed_rating_keys: Set[str])
                 f"removed={removed_count} allowed={len(allowed_rating_keys)}"
             )
 
-        # Return as bytes with XML declaration
-        return ET.tostring(root, encoding='unicode').encode('utf-8')
+        return result
 
-    except ET.ParseError as e:
+    except _FILTER_PARSE_ERRORS as e:
         logger.warning(f"XML_PARSE_ERROR: {e} - passing through unchanged")
-        return xml_bytes
+        return xml_bytes, -1, -1
     except Exception as e:
         logger.warning(f"FILTER_ERROR: {e} - passing through unchanged")
-        return xml_bytes
+        return xml_bytes, -1, -1
 
 
 def create_empty_media_container_xml() -> bytes:
@@ -122,14 +551,12 @@ def is_listing_endpoint(path: str) -> bool:
     Returns:
         True if this endpoint returns a list of items that should be filtered
     """
-    # Strip query string for cleaner matching
-    path_base = path.split('?')[0]
+    # Every alternative is anchored and ends in \b, which holds at '?' just
+    # as at the end of the string, so the query needn't be stripped first
+    return LIBRARY_LISTING_PATTERN.match(path) is not None
 
-    # Check against all listing patterns
-    for pattern in LIBRARY_LISTING_PATTERNS:
-        if pattern.search(path_base):
-            return True
-    return False
+
+_METADATA_PATH_PREFIX = '/library/metadata/'
 
 
 def extract_rating_key_from_path(path: str) -> Optional[str]:
@@ -143,53 +570,49 @@ def extract_rating_key_from_path(path: str) -> Optional[str]:
         ratingKey string or None if not found
     """
     # Try metadata pattern first
-    match = METADATA_PATTERN.match(path)
-    if match:
-        return match.group(1)
-
-    # Try artwork patterns
-    for pattern in ARTWORK_PATTERNS:
-        match = pattern.search(path)
+    if path.startswith(_METADATA_PATH_PREFIX):
+        match = METADATA_PATTERN.match(path)
         if match:
             return match.group(1)
 
+    # Artwork paths under /library/metadata/ already matched above, so only
+    # transcoded photos are left for the artwork patterns
+    if path.startswith('/photo/'):
+        for pattern in ARTWORK_PATTERNS:
+            match = pattern.match(path)
+            if match:
+                return match.group(1)
+
     return None
 
 
 def is_metadata_endpoint(path: str) -> bool:
     """Check if path is a metadata endpoint (not upload)."""
+    # Both patterns are anchored on this prefix; most proxied paths lack it
+    if not path.startswith(_METADATA_PATH_PREFIX):
+        return False
     # Must match metadata pattern but NOT upload pattern
-    if PLEX_UPLOAD_PATTERN.match(path.split('?')[0]):
+    if PLEX_UPLOAD_PATTERN.match(path.partition('?')[0]):
         return False
     return METADATA_PATTERN.match(path) is not None
 
 
-def extract_allowed_rating_keys(preview_config: Dict[str, Any]) -> Set[str]:
+def extract_allowed_rating_keys(preview_config: Dict[str, Any]) -> FrozenSet[str]:
     """
     Extract the set of allowed ratingKeys from preview configuration.
 
+    The keys are collected while building the PreviewIndex for the targets,
+    so the target list is walked once for both lookups.
+
     Args:
         preview_config: Loaded preview.yml configuration
 
     Returns:
-        Set of ratingKey strings that are allowed through the proxy
+        Frozen set of ratingKey strings that are allowed through the proxy
     """
     from caching import safe_preview_targets
 
-    allowed = set()
-    targets = safe_preview_targets(preview_config)
-
-    for target in targets:
-        # Support multiple key names for ratingKey
-        rating_key = (
-            target.get('ratingKey') or
-            target.get('rating_key') or
-            target.get('plex_id')
-        )
-        if rating_key:
-            allowed.add(str(rating_key))
-
-    return allowed
+    return get_preview_index(safe_preview_targets(preview_config)).allowed_rating_keys
 
 
 def extract_preview_targets(preview_config: Dict[str, Any]) -> List[Dict[str, Any]]:
@@ -203,13 +626,160 @@ def extract_preview_targets(preview_config: Dict[str, Any]) -> List[Dict[str, An
         List of target dicts with ratingKey, type, title, etc.
     """
     preview_data = preview_config.get('preview', {})
-    return preview_data.get('targets', [])
+    return prepare_preview_targets(preview_data.get('targets', []))
+
+
+def prepare_preview_targets(targets: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Return shallow copies of targets with derived lookup fields precomputed.
+
+    Adds '_title_lc' (the lowercased title) so search requests only lowercase
+    the query, and interns 'type' since it only takes a handful of values.
+    Copies are returned so the derived keys never leak back into the
+    preview config.
+
+    Args:
+        targets: Raw preview targets
+
+    The PreviewIndex is built here as well, so request handlers never
+    rebuild it.
+
+    Returns:
+        Prepared target dicts, as a PreparedTargets list
+    """
+    prepared = []
+    for target in targets:
+        target = dict(target)
+        title = target.get('title')
+        if isinstance(title, str):
+            target['_title_lc'] = title.lower()
+        target_type = target.get('type')
+        if isinstance(target_type, str):
+            target['type'] = sys.intern(target_type)
+        prepared.append(target)
+    return PreparedTargets(prepared)
 
 
 # ============================================================================
 # Mock Library Mode - Synthetic XML Generation
 # ============================================================================
 
+_MOVIE_TYPES = frozenset({'movie', 'movies'})
+_SERIES_TYPES = frozenset({'show', 'shows', 'series'})
+_SHOW_TYPES = _SERIES_TYPES | {'season', 'episode'}
+
+
+@dataclass(frozen=True, slots=True)
+class TargetKeys:
+    """
+    Normalized ratingKey strings for one preview target ('' when absent).
+
+    type is the lowercased target type, or None when the target has no
+    string type.
+    """
+    rating_key: str
+    parent: str
+    grandparent: str
+    type: Optional[str] = None
+
+
+@dataclass
+class PreviewIndex:
+    """
+    Lookup tables over a preview target list, built once per target list.
+
+    by_ancestor maps a parent or grandparent ratingKey to the positions of
+    targets declaring it. Targets missing either key may still learn it from
+    the metadata cache at request time, so their positions are kept in
+    unresolved and always re-checked. keys holds each target's normalized
+    ratingKeys by position, and allowed_rating_keys every non-empty ratingKey.
+    """
+    by_ancestor: Dict[str, List[int]] = field(default_factory=dict)
+    unresolved: List[int] = field(default_factory=list)
+    types_present: Set[str] = field(default_factory=set)
+    keys: List[TargetKeys] = field(default_factory=list)
+    allowed_rating_keys: FrozenSet[str] = frozenset()
+
+    @property
+    def has_movies(self) -> bool:
+        return not self.types_present.isdisjoint(_MOVIE_TYPES)
+
+    @property
+    def has_shows(self) -> bool:
+        return not self.types_present.isdisjoint(_SHOW_TYPES)
+
+    def child_candidates(self, parent_rating_key: str) -> List[int]:
+        """Positions of targets that may be children of parent_rating_key, in order."""
+        indexed = self.by_ancestor.get(parent_rating_key)
+        if not indexed:
+            return self.unresolved
+        if not self.unresolved:
+            return indexed
+        return sorted(set(indexed).union(self.unresolved))
+
+
+def build_preview_index(targets: List[Dict[str, Any]]) -> PreviewIndex:
+    """
+    Build a PreviewIndex for a target list.
+
+    Args:
+        targets: List of preview targets
+
+    Returns:
+        PreviewIndex for the targets
+    """
+    index = PreviewIndex()
+    allowed = set()
+    intern = sys.intern
+    by_ancestor = index.by_ancestor
+    for position, target in enumerate(targets):
+        get = target.get
+        # Support multiple key names for ratingKey; 'or' also skips empty values
+        # Interned: these strings are dict and set keys for every lookup
+        rating_key = intern(str(get('ratingKey') or get('rating_key') or get('plex_id') or ''))
+        if rating_key:
+            allowed.add(rating_key)
+        target_type = get('type')
+        if isinstance(target_type, str):
+            index.types_present.add(target_type)
+            target_type = intern(target_type.lower())
+        else:
+            target_type = None
+        parent = intern(str(get('parentRatingKey') or get('parent_rating_key') or ''))
+        grandparent = intern(str(get('grandparentRatingKey') or get('grandparent_rating_key') or ''))
+        index.keys.append(TargetKeys(rating_key, parent, grandparent, target_type))
+        if not parent or not grandparent:
+            index.unresolved.append(position)
+        # Each distinct ancestor once, without building a set per target
+        if parent:
+            by_ancestor.setdefault(parent, []).append(position)
+        if grandparent and grandparent != parent:
+            by_ancestor.setdefault(grandparent, []).append(position)
+    index.allowed_rating_keys = frozenset(allowed)
+    return index
+
+
+class PreparedTargets(list):
+    """
+    Target list returned by prepare_preview_targets, carrying its PreviewIndex.
+
+    The index is built once from the prepared copies. The proxy treats its
+    prepared targets as read-only, so the index stays in step with them.
+    """
+    __slots__ = ('preview_index',)
+
+    def __init__(self, targets: List[Dict[str, Any]]):
+        super().__init__(targets)
+        self.preview_index = build_preview_index(self)
+
+
+def get_preview_index(targets: List[Dict[str, Any]]) -> PreviewIndex:
+    """Return the PreviewIndex for targets, prebuilt for prepared target lists."""
+    if isinstance(targets, PreparedTargets):
+        return targets.preview_index
+    return build_preview_index(targets)
+
+
 def build_synthetic_section_detail_xml(section_id: str, targets: List[Dict[str, Any]]) -> bytes:
     """
     Build synthetic /library/sections/{id} XML response for a specific section.
@@ -225,8 +795,9 @@ def build_synthetic_section_detail_xml(section_id: str, targets: List[Dict[str,
         XML bytes for MediaContainer with the section's Directory element
     """
     # Determine section type based on targets
-    has_movies = any(t.get('type') in ('movie', 'movies') for t in targets)
-    has_shows = any(t.get('type') in ('show', 'shows', 'series', 'season', 'episode') for t in targets)
+    index = get_preview_index(targets)
+    has_movies = index.has_movies
+    has_shows = index.has_shows
 
     # Section 1 is Movies, Section 2 is TV Shows (our convention)
     if section_id == '1' or (has_movies and not has_shows):
@@ -252,15 +823,13 @@ def build_synthetic_section_detail_xml(section_id: str, targets: List[Dict[str,
             agent = 'tv.plex.agents.series'
             scanner = 'Plex TV Series'
 
-    root = ET.Element('MediaContainer', {
-        'size': '1',
-        'allowSync': '0',
-        'identifier': 'com.plexapp.plugins.library',
-        'mediaTagPrefix': '/system/bundle/media/flags/',
-        'mediaTagVersion': '1',
-    })
+    # The document is fixed per (section, type); Kometa asks for it repeatedly
+    cache_key = (section_id, section_type)
+    xml_bytes = _section_detail_xml_cache.get(cache_key)
+    if xml_bytes is not None:
+        return xml_bytes
 
-    ET.SubElement(root, 'Directory', {
+    directory = _xml_element('Directory', {
         'allowSync': '1',
         'art': f'/:/resources/{section_type}-fanart.jpg',
         'composite': f'/library/sections/{section_id}/composite/1234',
@@ -283,7 +852,24 @@ def build_synthetic_section_detail_xml(section_id: str, targets: List[Dict[str,
         'location': f'id={section_id}',
     })
 
-    return ET.tostring(root, encoding='unicode').encode('utf-8')
+    xml_bytes = _xml_element('MediaContainer', {
+        'size': '1',
+        'allowSync': '0',
+        'identifier': 'com.plexapp.plugins.library',
+        'mediaTagPrefix': '/system/bundle/media/flags/',
+        'mediaTagVersion': '1',
+    }, directory).encode('utf-8')
+
+    # Only a couple of section IDs are real; start over if something probes many
+    if len(_section_detail_xml_cache) >= _SECTION_DETAIL_XML_CACHE_MAX:
+        _section_detail_xml_cache.clear()
+    _section_detail_xml_cache[cache_key] = xml_bytes
+    return xml_bytes
+
+
+# Rendered section detail documents keyed by (section_id, section_type)
+_SECTION_DETAIL_XML_CACHE_MAX = 32
+_section_detail_xml_cache: Dict[Tuple[str, str], bytes] = {}
 
 
 def build_synthetic_collections_xml(section_id: str, path: Optional[str] = None) -> bytes:
@@ -306,50 +892,67 @@ def build_synthetic_collections_xml(section_id: str, path: Optional[str] = None)
     Returns:
         XML bytes for an empty MediaContainer (no collections) with optional Meta elements
     """
-    root = ET.Element('MediaContainer', {
-        'size': '0',
-        'allowSync': '1',
-        'art': f'/:/resources/collection-fanart.jpg',
-        'identifier': 'com.plexapp.plugins.library',
-        'librarySectionID': section_id,
-        'librarySectionTitle': 'Movies',
-        'librarySectionUUID': f'mock-uuid-{section_id}',
-        'mediaTagPrefix': '/system/bundle/media/flags/',
-        'mediaTagVersion': '1',
-        'thumb': f'/:/resources/collection.png',
-        'title1': 'Movies',
-        'title2': 'Collections',
-        'viewGroup': 'collection',
-        'viewMode': '65592',
-    })
+    include_meta = bool(path) and 'includeMeta=1' in path
+    cache_key = (section_id, include_meta)
+    xml_bytes = _collections_xml_cache.get(cache_key)
+    if xml_bytes is not None:
+        return xml_bytes
 
     # Add Meta element with collection FilteringType if includeMeta=1 in query
     # PlexAPI's _loadFilters method looks for these Meta elements
-    if path and 'includeMeta=1' in path:
-        meta = ET.SubElement(root, 'Meta')
-        collection_type = ET.SubElement(meta, 'Type', {
-            'type': 'collection',
-            'title': 'Collections',
-            'active': '1',
-            'key': f'/library/sections/{section_id}/collections',
-        })
+    meta = ''
+    if include_meta:
         # Add common filter fields for collections
         collection_filters = [
             ('label', 'string', 'Label'),
             ('collection', 'string', 'Collection'),
             ('addedAt', 'date', 'Date Added'),
         ]
-        for filter_key, filter_type, filter_title in collection_filters:
-            ET.SubElement(collection_type, 'Filter', {
+        filters = ''.join([
+            _xml_element('Filter', {
                 'filter': filter_key,
                 'filterType': filter_type,
                 'key': filter_key,
                 'title': filter_title,
                 'type': 'filter',
             })
+            for filter_key, filter_type, filter_title in collection_filters
+        ])
+        collection_type = _xml_element('Type', {
+            'type': 'collection',
+            'title': 'Collections',
+            'active': '1',
+            'key': f'/library/sections/{section_id}/collections',
+        }, filters)
+        meta = _xml_element('Meta', {}, collection_type)
 
     # Return empty container (no collections but with Meta if requested)
-    return ET.tostring(root, encoding='unicode').encode('utf-8')
+    xml_bytes = _xml_element('MediaContainer', {
+        'size': '0',
+        'allowSync': '1',
+        'art': f'/:/resources/collection-fanart.jpg',
+        'identifier': 'com.plexapp.plugins.library',
+        'librarySectionID': section_id,
+        'librarySectionTitle': 'Movies',
+        'librarySectionUUID': f'mock-uuid-{section_id}',
+        'mediaTagPrefix': '/system/bundle/media/flags/',
+        'mediaTagVersion': '1',
+        'thumb': f'/:/resources/collection.png',
+        'title1': 'Movies',
+        'title2': 'Collections',
+        'viewGroup': 'collection',
+        'viewMode': '65592',
+    }, meta).encode('utf-8')
+
+    if len(_collections_xml_cache) >= _COLLECTIONS_XML_CACHE_MAX:
+        _collections_xml_cache.clear()
+    _collections_xml_cache[cache_key] = xml_bytes
+    return xml_bytes
+
+
+# Rendered collections documents keyed by (section_id, include_meta)
+_COLLECTIONS_XML_CACHE_MAX = 32
+_collections_xml_cache: Dict[Tuple[str, bool], bytes] = {}
 
 
 def build_synthetic_filter_types_xml(section_id: str, targets: List[Dict[str, Any]]) -> bytes:
@@ -363,6 +966,9 @@ def build_synthetic_filter_types_xml(section_id: str, targets: List[Dict[str, An
     - MediaContainer with Type elements (one per libtype: movie, show, etc.)
     - Each Type contains Filter elements describing available filters
 
+    The document only depends on which libtypes are included, so each of
+    the few possible variants is rendered once and reused.
+
     Args:
         section_id: The requested section ID
         targets: List of preview targets to determine the library type
@@ -371,16 +977,28 @@ def build_synthetic_filter_types_xml(section_id: str, targets: List[Dict[str, An
         XML bytes for MediaContainer with Type and Filter elements
     """
     # Determine section type based on targets
-    has_movies = any(t.get('type') in ('movie', 'movies') for t in targets)
-    has_shows = any(t.get('type') in ('show', 'shows', 'series', 'season', 'episode') for t in targets)
+    index = get_preview_index(targets)
+    has_movies = index.has_movies
+    has_shows = index.has_shows
+
+    # Add movie type if we have movies, show types if we have shows
+    key = (
+        section_id == '1' or (has_movies and not has_shows),
+        section_id == '2' or (has_shows and not has_movies),
+    )
+    xml_bytes = _filter_types_xml_cache.get(key)
+    if xml_bytes is None:
+        xml_bytes = _render_filter_types_xml(*key)
+        _filter_types_xml_cache[key] = xml_bytes
+    return xml_bytes
 
-    # Build the MediaContainer
-    root = ET.Element('MediaContainer', {
-        'size': '1',
-        'allowSync': '0',
-        'identifier': 'com.plexapp.plugins.library',
-    })
 
+# Rendered filterTypes documents keyed by (include_movie, include_show)
+_filter_types_xml_cache: Dict[Tuple[bool, bool], bytes] = {}
+
+
+def _render_filter_types_xml(include_movie: bool, include_show: bool) -> bytes:
+    """Render a filterTypes document with the movie and/or show libtypes."""
     # Common movie filters (used by Kometa's plex_search)
     movie_filters = [
         {'filter': 'resolution', 'filterType': 'string', 'key': 'resolution', 'title': 'Resolution', 'type': 'filter'},
@@ -451,69 +1069,57 @@ def build_synthetic_filter_types_xml(section_id: str, targets: List[Dict[str, An
         {'filter': 'originallyAvailableAt', 'filterType': 'date', 'key': 'originallyAvailableAt', 'title': 'Air Date', 'type': 'filter'},
     ]
 
+    def type_element(attrs: Dict[str, str], filters: List[Dict[str, str]]) -> str:
+        # Filters are leaf elements, so they are formatted directly as strings
+        return _xml_element('Type', attrs, ''.join([_xml_element('Filter', f) for f in filters]))
+
+    types = []
+
     # Add movie type if we have movies
-    if section_id == '1' or (has_movies and not has_shows):
-        movie_type = ET.SubElement(root, 'Type', {
+    if include_movie:
+        types.append(type_element({
             'key': '1',
             'type': 'movie',
             'title': 'Movie',
             'active': '1',
-        })
-        for f in movie_filters:
-            ET.SubElement(movie_type, 'Filter', f)
+        }, movie_filters))
 
     # Add show types if we have shows
-    if section_id == '2' or (has_shows and not has_movies):
+    if include_show:
         # Show type
-        show_type = ET.SubElement(root, 'Type', {
+        types.append(type_element({
             'key': '2',
             'type': 'show',
             'title': 'Show',
             'active': '1',
-        })
-        for f in show_filters:
-            ET.SubElement(show_type, 'Filter', f)
+        }, show_filters))
 
         # Season type
-        season_type = ET.SubElement(root, 'Type', {
+        types.append(type_element({
             'key': '3',
             'type': 'season',
             'title': 'Season',
             'active': '0',
-        })
-        for f in season_filters:
-            ET.SubElement(season_type, 'Filter', f)
+        }, season_filters))
 
         # Episode type
-        episode_type = ET.SubElement(root, 'Type', {
+        types.append(type_element({
             'key': '4',
             'type': 'episode',
             'title': 'Episode',
             'active': '0',
-        })
-        for f in episode_filters:
-            ET.SubElement(episode_type, 'Filter', f)
-
-        # Update size to reflect number of types
-        root.set('size', '3')
-
-    return ET.tostring(root, encoding='unicode').encode('utf-8')
+        }, episode_filters))
 
+    return _xml_element('MediaContainer', {
+        # Size reflects the number of show types when they are present
+        'size': '3' if include_show else '1',
+        'allowSync': '0',
+        'identifier': 'com.plexapp.plugins.library',
+    }, ''.join(types)).encode('utf-8')
 
-def build_synthetic_library_sections_xml(targets: List[Dict[str, Any]]) -> bytes:
-    """
-    Build synthetic /library/sections XML response.
-
-    Creates minimal library sections for both Movies and TV Shows.
-    This ensures Kometa configs with both library types work correctly,
-    even if targets only include one type (e.g., only movies).
 
-    Args:
-        targets: List of preview targets (not used for section determination anymore)
-
-    Returns:
-        XML bytes for MediaContainer with Directory elements for sections
-    """
+def _render_library_sections_xml() -> bytes:
+    """Render the fixed /library/sections document served by the mock library."""
     # Always return both Movies and TV Shows sections
     # This ensures Kometa configs that define both libraries work correctly,
     # even when preview targets only include one type
@@ -522,20 +1128,14 @@ def build_synthetic_library_sections_xml(targets: List[Dict[str, Any]]) -> bytes
         {'key': '2', 'type': 'show', 'title': 'TV Shows', 'agent': 'tv.plex.agents.series', 'scanner': 'Plex TV Series'},
     ]
 
-    root = ET.Element('MediaContainer', {
-        'size': str(len(sections)),
-        'allowSync': '0',
-        'title1': 'Plex Library',
-    })
-
-    for section in sections:
-        ET.SubElement(root, 'Directory', {
+    directories = ''.join(
+        _xml_element('Directory', {
             'allowSync': '1',
-            'art': f'/:/resources/movie-fanart.jpg',
+            'art': '/:/resources/movie-fanart.jpg',
             'composite': f'/library/sections/{section["key"]}/composite/1234',
             'filters': '1',
             'refreshing': '0',
-            'thumb': f'/:/resources/movie.png',
+            'thumb': '/:/resources/movie.png',
             'key': section['key'],
             'type': section['type'],
             'title': section['title'],
@@ -551,13 +1151,78 @@ def build_synthetic_library_sections_xml(targets: List[Dict[str, Any]]) -> bytes
             'contentChangedAt': '1700000000',
             'hidden': '0',
         })
+        for section in sections
+    )
+
+    return _xml_element('MediaContainer', {
+        'size': str(len(sections)),
+        'allowSync': '0',
+        'title1': 'Plex Library',
+    }, directories).encode('utf-8')
+
+
+def build_synthetic_library_sections_xml(targets: List[Dict[str, Any]]) -> bytes:
+    """
+    Build synthetic /library/sections XML response.
 
-    return ET.tostring(root, encoding='unicode').encode('utf-8')
+    Creates minimal library sections for both Movies and TV Shows.
+    This ensures Kometa configs with both library types work correctly,
+    even if targets only include one type (e.g., only movies). The
+    document does not depend on the targets, so it is rendered once.
 
+    Args:
+        targets: List of preview targets (not used for section determination anymore)
 
-def _build_media_element(metadata: Dict[str, Any]) -> ET.Element:
+    Returns:
+        XML bytes for MediaContainer with Directory elements for sections
+    """
+    global _library_sections_xml
+    if _library_sections_xml is None:
+        _library_sections_xml = _render_library_sections_xml()
+    return _library_sections_xml
+
+
+_library_sections_xml: Optional[bytes] = None
+
+
+# Map user-friendly resolution to Plex format
+_RESOLUTION_MAP = {
+    '4K': '4k',
+    '4k': '4k',
+    '2160p': '4k',
+    '1080p': '1080',
+    '1080': '1080',
+    '720p': '720',
+    '720': '720',
+    '480p': '480',
+    '480': '480',
+    'SD': 'sd',
+}
+
+# Map user-friendly audio codec to Plex format
+_AUDIO_CODEC_MAP = {
+    'Dolby Atmos': 'truehd',
+    'TrueHD': 'truehd',
+    'truehd': 'truehd',
+    'DTS-HD MA': 'dca-ma',
+    'DTS-HD': 'dca-ma',
+    'dts-hd': 'dca-ma',
+    'DTS': 'dca',
+    'dts': 'dca',
+    'AAC': 'aac',
+    'aac': 'aac',
+    'AC3': 'ac3',
+    'ac3': 'ac3',
+    'EAC3': 'eac3',
+    'eac3': 'eac3',
+    'FLAC': 'flac',
+    'flac': 'flac',
+}
+
+
+def _build_media_element(metadata: Dict[str, Any]) -> str:
     """
-    Build a Media XML element from preview metadata.
+    Build a Media XML fragment from preview metadata.
 
     This allows overlays like resolution, audio_codec, etc. to match
     without querying Plex for actual mediainfo.
@@ -566,53 +1231,20 @@ def _build_media_element(metadata: Dict[str, Any]) -> ET.Element:
         metadata: Preview metadata dict with resolution, audioCodec, etc.
 
     Returns:
-        Media XML element with Part child
-    """
-    # Map user-friendly resolution to Plex format
-    resolution_map = {
-        '4K': '4k',
-        '4k': '4k',
-        '2160p': '4k',
-        '1080p': '1080',
-        '1080': '1080',
-        '720p': '720',
-        '720': '720',
-        '480p': '480',
-        '480': '480',
-        'SD': 'sd',
-    }
-
-    # Map user-friendly audio codec to Plex format
-    audio_codec_map = {
-        'Dolby Atmos': 'truehd',
-        'TrueHD': 'truehd',
-        'truehd': 'truehd',
-        'DTS-HD MA': 'dca-ma',
-        'DTS-HD': 'dca-ma',
-        'dts-hd': 'dca-ma',
-        'DTS': 'dca',
-        'dts': 'dca',
-        'AAC': 'aac',
-        'aac': 'aac',
-        'AC3': 'ac3',
-        'ac3': 'ac3',
-        'EAC3': 'eac3',
-        'eac3': 'eac3',
-        'FLAC': 'flac',
-        'flac': 'flac',
-    }
-
+        Media XML fragment with Part child
+    """
     media_attrs = {}
 
     # Set video resolution
-    if metadata.get('resolution'):
-        res = metadata['resolution']
-        media_attrs['videoResolution'] = resolution_map.get(res, res.lower())
+    res = metadata.get('resolution')
+    if res:
+        media_attrs['videoResolution'] = _RESOLUTION_MAP.get(res) or res.lower()
 
     # Set audio codec
-    if metadata.get('audioCodec'):
-        codec = metadata['audioCodec']
-        media_attrs['audioCodec'] = audio_codec_map.get(codec, codec.lower())
+    codec = metadata.get('audioCodec')
+    audio_codec = (_AUDIO_CODEC_MAP.get(codec) or codec.lower()) if codec else None
+    if audio_codec:
+        media_attrs['audioCodec'] = audio_codec
 
     # Set HDR/DV attributes
     if metadata.get('hdr'):
@@ -620,17 +1252,37 @@ def _build_media_element(metadata: Dict[str, Any]) -> ET.Element:
     if metadata.get('dolbyVision'):
         media_attrs['DOVIPresent'] = '1'
 
-    # Create Media element
-    media_elem = ET.Element('Media', media_attrs)
-
     # Add Part child (required for some overlay matchers)
     part_attrs = {}
-    if metadata.get('audioCodec'):
-        codec = metadata['audioCodec']
-        part_attrs['audioProfile'] = audio_codec_map.get(codec, codec.lower())
-    ET.SubElement(media_elem, 'Part', part_attrs)
+    if audio_codec:
+        part_attrs['audioProfile'] = audio_codec
 
-    return media_elem
+    return _xml_element('Media', media_attrs, _xml_element('Part', part_attrs))
+
+
+def _xml_element(tag: str, attrs: Dict[str, Any], content: str = '') -> str:
+    """
+    Format one XML element as a string.
+
+    Attribute values are escaped like ElementTree does; content must already
+    be serialized XML. Elements without content are self-closing.
+    """
+    esc = _escape_xml_attrib
+    attr_text = ''.join([f' {key}="{esc(str(value))}"' for key, value in attrs.items()])
+    if content:
+        return f'<{tag}{attr_text}>{content}</{tag}>'
+    return f'<{tag}{attr_text} />'
+
+
+# Precomputed documents for the common "nothing matched" responses
+_EMPTY_LISTING_XML = b'<MediaContainer size="0" totalSize="0" offset="0" allowSync="1" />'
+_EMPTY_CHILDREN_XML = b'<MediaContainer size="0" totalSize="0" />'
+
+
+def _container_xml(attrs: Dict[str, str], children: List[str]) -> bytes:
+    """Serialize a MediaContainer document from pre-built child fragments."""
+    attr_text = ''.join(f' {key}="{_escape_xml_attrib(value)}"' for key, value in attrs.items())
+    return f'<MediaContainer{attr_text}>{"".join(children)}</MediaContainer>'.encode('utf-8')
 
 
 def build_synthetic_listing_xml(
@@ -657,30 +1309,93 @@ def build_synthetic_listing_xml(
     Returns:
         XML bytes for MediaContainer with Video/Directory elements and optional Meta elements
     """
+    _, xml_bytes = build_synthetic_listing_xml_with_count(
+        targets,
+        section_id=section_id,
+        query=query,
+        metadata_cache=metadata_cache,
+        path=path
+    )
+    return xml_bytes
+
+
+def build_synthetic_listing_xml_with_count(
+    targets: List[Dict[str, Any]],
+    section_id: Optional[str] = None,
+    query: Optional[str] = None,
+    metadata_cache: Optional[Dict[str, ET.Element]] = None,
+    path: Optional[str] = None
+) -> Tuple[int, bytes]:
+    """
+    Variant of build_synthetic_listing_xml that also reports the item count.
+
+    Returns:
+        Tuple of (item_count, XML bytes)
+    """
+    items = _build_listing_items(targets, query, metadata_cache)
+    include_meta = bool(path and 'includeMeta=1' in path)
+    if not items and not include_meta:
+        return 0, _EMPTY_LISTING_XML
+
+    children = list(items)
+    # Add Meta elements with FilteringType if includeMeta=1 in query
+    # PlexAPI's _loadFilters method looks for these Meta elements to populate availableLibtypes
+    if include_meta:
+        children.extend(_build_listing_meta_elements(targets, section_id))
+
+    attrs = {
+        'size': str(len(items)),
+        'totalSize': str(len(items)),
+        'offset': '0',
+        'allowSync': '1',
+    }
+    return len(items), _container_xml(attrs, children)
+
+
+# Map preview show status to the Plex status string
+_SHOW_STATUS_MAP = {
+    'returning': 'Returning Series',
+    'ended': 'Ended',
+    'canceled': 'Canceled',
+    'airing': 'Continuing',
+}
+
+
+def _build_listing_items(
+    targets: List[Dict[str, Any]],
+    query: Optional[str],
+    metadata_cache: Optional[Dict[str, ET.Element]]
+) -> List[str]:
+    """Build the Video/Directory item fragments for a synthetic listing."""
     items = []
+    query_lower = query.lower() if query else None
+    # Local aliases keep global lookups out of the per-target loop
+    append = items.append
+    xml_element = _xml_element
+    build_media = _build_media_element
+    # Normalized ratingKey/parent strings come from the cached index
+    target_keys = get_preview_index(targets).keys
 
-    for target in targets:
-        rating_key = str(
-            target.get('ratingKey') or
-            target.get('rating_key') or
-            target.get('plex_id') or
-            ''
-        )
+    for target, keys in zip(targets, target_keys):
+        rating_key = keys.rating_key
 
         if not rating_key:
             continue
 
-        target_type = target.get('type', 'movie').lower()
+        # Lowercased once per target list by the index
+        target_type = keys.type
+        if target_type is None:
+            target_type = target.get('type', 'movie').lower()
         title = target.get('title', f'Item {rating_key}')
         year = target.get('year', '')
 
         # Get parent keys from target or cache
-        parent_rating_key = target.get('parentRatingKey') or target.get('parent_rating_key', '')
-        grandparent_rating_key = target.get('grandparentRatingKey') or target.get('grandparent_rating_key', '')
+        parent_rating_key = keys.parent
+        grandparent_rating_key = keys.grandparent
 
         # Try to get from cache if not in target
-        if metadata_cache and rating_key in metadata_cache:
-            cached = metadata_cache[rating_key]
+        cached = metadata_cache.get(rating_key) if metadata_cache else None
+        if cached is not None:
             if not parent_rating_key:
                 parent_rating_key = cached.get('parentRatingKey', '')
             if not grandparent_rating_key:
@@ -691,194 +1406,174 @@ def build_synthetic_listing_xml(
             if not year:
                 year = cached.get('year', '')
 
+        # Apply search filter before building anything for this item
+        if query_lower:
+            # Prepared targets carry a pre-lowered title
+            title_lc = target.get('_title_lc') if title is target.get('title') else None
+            if title_lc is None:
+                title_lc = str(title).lower()
+            if query_lower not in title_lc:
+                continue
+
         # Get preview metadata for instant overlay application (skips TMDb queries)
         metadata = target.get('metadata', {})
 
+        # Every key and artwork path of the item shares this prefix
+        item_path = f'/library/metadata/{rating_key}'
+
         # Build the item element based on type
-        if target_type in ('movie', 'movies'):
-            elem = ET.Element('Video', {
+        if target_type in _MOVIE_TYPES:
+            attrs = {
                 'ratingKey': rating_key,
-                'key': f'/library/metadata/{rating_key}',
+                'key': item_path,
                 'type': 'movie',
                 'title': title,
-            })
+            }
             if year:
-                elem.set('year', str(year))
-            elem.set('thumb', f'/library/metadata/{rating_key}/thumb')
-            elem.set('art', f'/library/metadata/{rating_key}/art')
+                attrs['year'] = str(year)
+            attrs['thumb'] = f'{item_path}/thumb'
+            attrs['art'] = f'{item_path}/art'
 
             # Add Media element with resolution/audio metadata for overlay matching
-            if metadata:
-                media_elem = _build_media_element(metadata)
-                elem.append(media_elem)
+            media = build_media(metadata) if metadata else ''
+            append(xml_element('Video', attrs, media))
 
-            items.append(elem)
-
-        elif target_type in ('show', 'shows', 'series'):
-            elem = ET.Element('Directory', {
+        elif target_type in _SERIES_TYPES:
+            attrs = {
                 'ratingKey': rating_key,
-                'key': f'/library/metadata/{rating_key}/children',
+                'key': f'{item_path}/children',
                 'type': 'show',
                 'title': title,
-            })
+            }
             if year:
-                elem.set('year', str(year))
-            elem.set('thumb', f'/library/metadata/{rating_key}/thumb')
-            elem.set('art', f'/library/metadata/{rating_key}/art')
+                attrs['year'] = str(year)
+            attrs['thumb'] = f'{item_path}/thumb'
+            attrs['art'] = f'{item_path}/art'
 
             # Add status attribute for status overlay
             if metadata and metadata.get('status'):
-                status_map = {
-                    'returning': 'Returning Series',
-                    'ended': 'Ended',
-                    'canceled': 'Canceled',
-                    'airing': 'Continuing',
-                }
-                elem.set('status', status_map.get(metadata['status'], metadata['status']))
+                attrs['status'] = _SHOW_STATUS_MAP.get(metadata['status'], metadata['status'])
 
-            items.append(elem)
+            append(xml_element('Directory', attrs))
 
         elif target_type == 'season':
-            elem = ET.Element('Directory', {
+            attrs = {
                 'ratingKey': rating_key,
-                'key': f'/library/metadata/{rating_key}/children',
+                'key': f'{item_path}/children',
                 'type': 'season',
                 'title': title,
                 'index': str(target.get('index', target.get('seasonNumber', 1))),
-            })
+            }
             if parent_rating_key:
-                elem.set('parentRatingKey', str(parent_rating_key))
-            elem.set('thumb', f'/library/metadata/{rating_key}/thumb')
+                attrs['parentRatingKey'] = str(parent_rating_key)
+            attrs['thumb'] = f'{item_path}/thumb'
 
             # Add Media element for resolution metadata
-            if metadata:
-                media_elem = _build_media_element(metadata)
-                elem.append(media_elem)
-
-            items.append(elem)
+            media = build_media(metadata) if metadata else ''
+            append(xml_element('Directory', attrs, media))
 
         elif target_type == 'episode':
-            elem = ET.Element('Video', {
+            attrs = {
                 'ratingKey': rating_key,
-                'key': f'/library/metadata/{rating_key}',
+                'key': item_path,
                 'type': 'episode',
                 'title': title,
                 'index': str(target.get('index', target.get('episodeNumber', 1))),
                 'parentIndex': str(target.get('parentIndex', target.get('seasonNumber', 1))),
-            })
+            }
             if parent_rating_key:
-                elem.set('parentRatingKey', str(parent_rating_key))
+                attrs['parentRatingKey'] = str(parent_rating_key)
             if grandparent_rating_key:
-                elem.set('grandparentRatingKey', str(grandparent_rating_key))
-            elem.set('thumb', f'/library/metadata/{rating_key}/thumb')
+                attrs['grandparentRatingKey'] = str(grandparent_rating_key)
+            attrs['thumb'] = f'{item_path}/thumb'
 
             # Add Media element for resolution/audio metadata
-            if metadata:
-                media_elem = _build_media_element(metadata)
-                elem.append(media_elem)
-
-            items.append(elem)
+            media = build_media(metadata) if metadata else ''
+            append(xml_element('Video', attrs, media))
 
         else:
             # Unknown type - default to Video
-            elem = ET.Element('Video', {
+            append(xml_element('Video', {
                 'ratingKey': rating_key,
-                'key': f'/library/metadata/{rating_key}',
+                'key': item_path,
                 'type': target_type,
                 'title': title,
-            })
-            items.append(elem)
-
-    # Apply search filter if query provided
-    if query:
-        query_lower = query.lower()
-        items = [
-            item for item in items
-            if query_lower in item.get('title', '').lower()
-        ]
+            }))
 
-    # Build MediaContainer
-    root = ET.Element('MediaContainer', {
-        'size': str(len(items)),
-        'totalSize': str(len(items)),
-        'offset': '0',
-        'allowSync': '1',
-    })
+    return items
 
-    for item in items:
-        root.append(item)
 
-    # Add Meta elements with FilteringType if includeMeta=1 in query
-    # PlexAPI's _loadFilters method looks for these Meta elements to populate availableLibtypes
-    if path and 'includeMeta=1' in path:
-        # Determine library type from targets
-        has_movies = any(t.get('type') in ('movie', 'movies') for t in targets)
-        has_shows = any(t.get('type') in ('show', 'shows', 'series', 'season', 'episode') for t in targets)
-
-        # Add movie FilteringType Meta element with common filters
-        if has_movies or section_id == '1':
-            meta = ET.SubElement(root, 'Meta')
-            filtering_type = ET.SubElement(meta, 'Type', {
-                'type': 'movie',
-                'title': 'Movies',
-                'active': '1',
-                'key': '/library/sections/1/all?type=1',
-            })
-            # Add common filter fields that Kometa uses
-            common_filters = [
-                ('label', 'string', 'Label'),
-                ('resolution', 'string', 'Resolution'),
-                ('audioCodec', 'string', 'Audio Codec'),
-                ('videoCodec', 'string', 'Video Codec'),
-                ('hdr', 'boolean', 'HDR'),
-                ('genre', 'string', 'Genre'),
-                ('year', 'integer', 'Year'),
-                ('contentRating', 'string', 'Content Rating'),
-                ('studio', 'string', 'Studio'),
-                ('collection', 'string', 'Collection'),
-                ('director', 'string', 'Director'),
-                ('actor', 'string', 'Actor'),
-                ('addedAt', 'date', 'Date Added'),
-                ('rating', 'float', 'Critic Rating'),
-                ('audienceRating', 'float', 'Audience Rating'),
-            ]
-            for filter_key, filter_type, filter_title in common_filters:
-                ET.SubElement(filtering_type, 'Filter', {
-                    'filter': filter_key,
-                    'filterType': filter_type,
-                    'key': filter_key,
-                    'title': filter_title,
-                    'type': 'filter',
-                })
-
-        # Add show FilteringTypes if needed
-        if has_shows or section_id == '2':
-            # Show type
-            meta = ET.SubElement(root, 'Meta')
-            ET.SubElement(meta, 'Type', {
-                'type': 'show',
-                'title': 'Shows',
-                'active': '1',
-                'key': '/library/sections/2/all?type=2',
-            })
-            # Season type
-            meta = ET.SubElement(root, 'Meta')
-            ET.SubElement(meta, 'Type', {
-                'type': 'season',
-                'title': 'Seasons',
-                'active': '0',
-                'key': '/library/sections/2/all?type=3',
-            })
-            # Episode type
-            meta = ET.SubElement(root, 'Meta')
-            ET.SubElement(meta, 'Type', {
-                'type': 'episode',
-                'title': 'Episodes',
-                'active': '0',
-                'key': '/library/sections/2/all?type=4',
+def _build_listing_meta_elements(targets: List[Dict[str, Any]], section_id: Optional[str]) -> List[str]:
+    """Build FilteringType Meta fragments for includeMeta=1 listing requests."""
+    metas = []
+
+    # Determine library type from targets
+    index = get_preview_index(targets)
+    has_movies = index.has_movies
+    has_shows = index.has_shows
+
+    # Add movie FilteringType Meta element with common filters
+    if has_movies or section_id == '1':
+        # Add common filter fields that Kometa uses
+        common_filters = [
+            ('label', 'string', 'Label'),
+            ('resolution', 'string', 'Resolution'),
+            ('audioCodec', 'string', 'Audio Codec'),
+            ('videoCodec', 'string', 'Video Codec'),
+            ('hdr', 'boolean', 'HDR'),
+            ('genre', 'string', 'Genre'),
+            ('year', 'integer', 'Year'),
+            ('contentRating', 'string', 'Content Rating'),
+            ('studio', 'string', 'Studio'),
+            ('collection', 'string', 'Collection'),
+            ('director', 'string', 'Director'),
+            ('actor', 'string', 'Actor'),
+            ('addedAt', 'date', 'Date Added'),
+            ('rating', 'float', 'Critic Rating'),
+            ('audienceRating', 'float', 'Audience Rating'),
+        ]
+        filters = ''.join(
+            _xml_element('Filter', {
+                'filter': filter_key,
+                'filterType': filter_type,
+                'key': filter_key,
+                'title': filter_title,
+                'type': 'filter',
             })
+            for filter_key, filter_type, filter_title in common_filters
+        )
+        metas.append(_xml_element('Meta', {}, _xml_element('Type', {
+            'type': 'movie',
+            'title': 'Movies',
+            'active': '1',
+            'key': '/library/sections/1/all?type=1',
+        }, filters)))
 
-    return ET.tostring(root, encoding='unicode').encode('utf-8')
+    # Add show FilteringTypes if needed
+    if has_shows or section_id == '2':
+        # Show type
+        metas.append(_xml_element('Meta', {}, _xml_element('Type', {
+            'type': 'show',
+            'title': 'Shows',
+            'active': '1',
+            'key': '/library/sections/2/all?type=2',
+        })))
+        # Season type
+        metas.append(_xml_element('Meta', {}, _xml_element('Type', {
+            'type': 'season',
+            'title': 'Seasons',
+            'active': '0',
+            'key': '/library/sections/2/all?type=3',
+        })))
+        # Episode type
+        metas.append(_xml_element('Meta', {}, _xml_element('Type', {
+            'type': 'episode',
+            'title': 'Episodes',
+            'active': '0',
+            'key': '/library/sections/2/all?type=4',
+        })))
+
+    return metas
 
 
 def build_synthetic_children_xml(
@@ -899,34 +1594,42 @@ def build_synthetic_children_xml(
     Returns:
         XML bytes for MediaContainer with child elements
     """
+    _, xml_bytes = build_synthetic_children_xml_with_count(parent_rating_key, targets, metadata_cache)
+    return xml_bytes
+
+
+def build_synthetic_children_xml_with_count(
+    parent_rating_key: str,
+    targets: List[Dict[str, Any]],
+    metadata_cache: Optional[Dict[str, ET.Element]] = None
+) -> Tuple[int, bytes]:
+    """
+    Variant of build_synthetic_children_xml that also reports the child count.
+
+    Returns:
+        Tuple of (child_count, XML bytes)
+    """
     children = []
+    index = get_preview_index(targets)
 
-    for target in targets:
-        rating_key = str(
-            target.get('ratingKey') or
-            target.get('rating_key') or
-            target.get('plex_id') or
-            ''
-        )
+    for position in index.child_candidates(parent_rating_key):
+        keys = index.keys[position]
+        rating_key = keys.rating_key
 
         if not rating_key:
             continue
 
         # Check if this target's parent matches
-        target_parent = str(
-            target.get('parentRatingKey') or
-            target.get('parent_rating_key') or
-            ''
-        )
-        target_grandparent = str(
-            target.get('grandparentRatingKey') or
-            target.get('grandparent_rating_key') or
-            ''
-        )
-
-        # Also check metadata cache for parent relationships
-        if metadata_cache and rating_key in metadata_cache:
-            cached = metadata_cache[rating_key]
+        target = targets[position]
+        target_parent = keys.parent
+        target_grandparent = keys.grandparent
+
+        # Also check metadata cache for parent relationships, only needed
+        # while one of them is still unknown
+        cached = None
+        if metadata_cache and not (target_parent and target_grandparent):
+            cached = metadata_cache.get(rating_key)
+        if cached is not None:
             if not target_parent:
                 target_parent = cached.get('parentRatingKey', '')
             if not target_grandparent:
@@ -934,22 +1637,23 @@ def build_synthetic_children_xml(
 
         # This item is a child if its parent or grandparent matches
         if target_parent == parent_rating_key or target_grandparent == parent_rating_key:
-            target_type = target.get('type', '').lower()
+            target_type = keys.type
+            if target_type is None:
+                target_type = target.get('type', '').lower()
             title = target.get('title', f'Item {rating_key}')
 
             if target_type == 'season':
-                elem = ET.Element('Directory', {
+                children.append(_xml_element('Directory', {
                     'ratingKey': rating_key,
                     'key': f'/library/metadata/{rating_key}/children',
                     'type': 'season',
                     'title': title,
                     'index': str(target.get('index', target.get('seasonNumber', 1))),
                     'parentRatingKey': parent_rating_key,
-                })
-                children.append(elem)
+                }))
 
             elif target_type == 'episode':
-                elem = ET.Element('Video', {
+                attrs = {
                     'ratingKey': rating_key,
                     'key': f'/library/metadata/{rating_key}',
                     'type': 'episode',
@@ -957,26 +1661,31 @@ def build_synthetic_children_xml(
                     'index': str(target.get('index', target.get('episodeNumber', 1))),
                     'parentIndex': str(target.get('parentIndex', target.get('seasonNumber', 1))),
                     'parentRatingKey': target_parent,
-                })
+                }
                 if target_grandparent:
-                    elem.set('grandparentRatingKey', target_grandparent)
-                children.append(elem)
+                    attrs['grandparentRatingKey'] = target_grandparent
+                children.append(_xml_element('Video', attrs))
+
+    if not children:
+        return 0, _EMPTY_CHILDREN_XML
 
-    root = ET.Element('MediaContainer', {
+    attrs = {
         'size': str(len(children)),
         'totalSize': str(len(children)),
-    })
+    }
+    return len(children), _container_xml(attrs, children)
 
-    for child in children:
-        root.append(child)
 
-    return ET.tostring(root, encoding='unicode').encode('utf-8')
+_LIBRARY_SECTIONS_PATH = '/library/sections'
+_LIBRARY_SECTIONS_PATH_LEN = len(_LIBRARY_SECTIONS_PATH)
 
 
 def is_library_sections_endpoint(path: str) -> bool:
     """Check if path is /library/sections (not a sub-path)."""
-    path_base = path.split('?')[0]
-    return LIBRARY_SECTIONS_PATTERN.match(path_base) is not None
+    # Prefix plus boundary check; equivalent to LIBRARY_SECTIONS_PATTERN
+    if not path.startswith(_LIBRARY_SECTIONS_PATH):
+        return False
+    return len(path) == _LIBRARY_SECTIONS_PATH_LEN or path[_LIBRARY_SECTIONS_PATH_LEN] == '?'
 
 
 def is_library_section_detail_endpoint(path: str) -> Optional[str]:
@@ -985,8 +1694,8 @@ def is_library_section_detail_endpoint(path: str) -> Optional[str]:
 
     Returns the section ID if matched, None otherwise.
     """
-    path_base = path.split('?')[0]
-    match = LIBRARY_SECTION_DETAIL_PATTERN.match(path_base)
+    # The pattern stops at '?', so the query string never needs splitting off
+    match = LIBRARY_SECTION_DETAIL_PATTERN.match(path)
     return match.group(1) if match else None
 
 
@@ -996,8 +1705,8 @@ def is_children_endpoint(path: str) -> Optional[str]:
 
     Returns the parent ratingKey if it matches, None otherwise.
     """
-    path_base = path.split('?')[0]
-    match = CHILDREN_PATTERN.match(path_base)
+    # The pattern stops at the '?', so the query needn't be split off
+    match = CHILDREN_PATTERN.match(path)
     return match.group(1) if match else None
 
 
@@ -1010,8 +1719,8 @@ def is_filter_types_endpoint(path: str) -> Optional[str]:
 
     Returns the section ID if matched, None otherwise.
     """
-    path_base = path.split('?')[0]
-    match = LIBRARY_FILTER_TYPES_PATTERN.match(path_base)
+    # The pattern stops at '?', so the query string never needs splitting off
+    match = LIBRARY_FILTER_TYPES_PATTERN.match(path)
     return match.group(1) if match else None
 
 
@@ -1027,9 +1736,9 @@ def is_collections_endpoint(path: str) -> Optional[str]:
 
     Returns the section ID if matched, None otherwise.
     """
-    path_base = path.split('?')[0].rstrip('/')
+    path_base = path.partition('?')[0].rstrip('/')
     # Match /library/sections/{id}/collections
-    match = re.match(r'^/library/sections/(\d+)/collections$', path_base)
+    match = LIBRARY_COLLECTIONS_PATTERN.match(path_base)
     return match.group(1) if match else None
 
 
@@ -1039,14 +1748,32 @@ def extract_section_id(path: str) -> Optional[str]:
     return match.group(1) if match else None
 
 
+# Search parameter names in priority order
+_SEARCH_QUERY_PARAMS = ('query', 'title', 'search')
+
+
 def extract_search_query(path: str) -> Optional[str]:
     """Extract search query from path query string."""
-    parsed = urlsplit(path)
-    params = parse_qs(parsed.query)
+    # Request paths never carry a scheme or host, so urlsplit() is overkill
+    query_string = path.partition('#')[0].partition('?')[2]
+    if not query_string:
+        return None
+    # Hand-rolled parse_qs(): only the first non-blank value of each wanted
+    # parameter is kept, and only those values are percent-decoded
+    found = {}
+    for pair in query_string.split('&'):
+        name, _, value = pair.partition('=')
+        if not value:
+            continue
+        if '%' in name or '+' in name:
+            name = unquote_plus(name)
+        if name in _SEARCH_QUERY_PARAMS and name not in found:
+            found[name] = value
     # Check common query parameter names
-    for key in ('query', 'title', 'search'):
-        if key in params:
-            return params[key][0]
+    for key in _SEARCH_QUERY_PARAMS:
+        value = found.get(key)
+        if value is not None:
+            return unquote_plus(value)
     return None
 
 
@@ -1054,57 +1781,145 @@ def extract_search_query(path: str) -> Optional[str]:
 # Image Detection Helpers
 # ============================================================================
 
+# Leading magic numbers as big-endian integers, so sniffing is one
+# int.from_bytes() plus integer compares
+_JPEG_MAGIC = 0xFFD8          # first two bytes
+_PNG_MAGIC = 0x89504E47       # b'\x89PNG', followed by b'\r\n\x1a\n'
+_RIFF_MAGIC = 0x52494646      # b'RIFF', with b'WEBP' at offset 8
+# First byte of each magic, so non-image bodies are rejected on one byte
+_IMAGE_FIRST_BYTES = frozenset({_JPEG_MAGIC >> 8, _PNG_MAGIC >> 24, _RIFF_MAGIC >> 24})
+
+
+def _sniff_image_type(data: bytes) -> Optional[str]:
+    """Return 'jpg', 'png' or 'webp' from magic bytes, or None if unrecognized."""
+    if not data or data[0] not in _IMAGE_FIRST_BYTES:
+        return None
+    head = data[:4]
+    if len(head) < 4:
+        return 'jpg' if head[:2] == b'\xff\xd8' else None
+    magic = int.from_bytes(head, 'big')
+    if magic >> 16 == _JPEG_MAGIC:
+        return 'jpg'
+    if magic == _PNG_MAGIC and data[4:8] == b'\r\n\x1a\n':
+        return 'png'
+    if magic == _RIFF_MAGIC and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def _image_data_type(data: bytes) -> Optional[str]:
+    """Return the image type of a whole image body, or None if it is not one."""
+    if len(data) < 8:
+        return None
+    return _sniff_image_type(data)
+
+
 def is_image_data(data: bytes) -> bool:
     """Check if bytes represent an image by magic bytes."""
-    if len(data) < 8:
-        return False
-    # JPEG
-    if data[:2] == b'\xff\xd8':
-        return True
-    # PNG
-    if data[:8] == b'\x89PNG\r\n\x1a\n':
-        return True
-    # WebP
-    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
-        return True
-    return False
+    return _image_data_type(data) is not None
 
 
 def detect_image_type(data: bytes) -> str:
     """Detect image type from magic bytes."""
-    if len(data) >= 2 and data[:2] == b'\xff\xd8':
-        return 'jpg'
-    if len(data) >= 8 and data[:8] == b'\x89PNG\r\n\x1a\n':
-        return 'png'
-    if len(data) >= 12 and data[:4] == b'RIFF' and data[8:12] == b'WEBP':
-        return 'webp'
-    return 'jpg'
+    return _sniff_image_type(data) or 'jpg'
+
+
+_IMAGE_FILENAME_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+_IMAGE_FILENAME_EXTENSIONS_BYTES = tuple(ext.encode('ascii') for ext in _IMAGE_FILENAME_EXTENSIONS)
+_IMAGE_FILENAME_EXTENSION_MAX = max(map(len, _IMAGE_FILENAME_EXTENSIONS))
+# Closes the synthetic headers the email fallback puts in front of the body
+_MIME_HEADER_END = b'\r\nMIME-Version: 1.0\r\n\r\n'
+
+# Largest header block the multipart scanner accepts for a single part
+_MULTIPART_HEADER_MAX = 8192
+_PLAIN_TRANSFER_ENCODINGS = (b'', b'binary', b'8bit', b'7bit')
+
+
+def _scan_multipart_image(body: bytes, boundary: str) -> Optional[tuple]:
+    """
+    Find the first image part of a multipart body with bytes.find().
+
+    Only handles the plain layout uploads use in practice: unfolded headers,
+    a quoted or bare filename, and no transfer encoding. Returns None for
+    anything else (or when no image part is found) so the caller can fall
+    back to the email parser.
+
+    Returns:
+        Tuple of (image_bytes, extension), or None
+    """
+    delimiter = b'--' + boundary.encode('latin-1')
+    pos = body.find(delimiter)
+    while pos >= 0:
+        pos += len(delimiter)
+        if body.startswith(b'--', pos):
+            return None
+        line_end = body.find(b'\r\n', pos)
+        if line_end < 0:
+            return None
+        # Part headers are a few lines; a part without a blank line close by
+        # is left to the email parser instead of searching the whole body
+        headers_end = body.find(b'\r\n\r\n', line_end, line_end + _MULTIPART_HEADER_MAX)
+        if headers_end < 0:
+            return None
+        content_start = headers_end + 4
+        next_pos = body.find(b'\r\n' + delimiter, content_start)
+        if next_pos < 0:
+            return None
+
+        part_ct = b''
+        filename = b''
+        for line in body[line_end + 2:headers_end].split(b'\r\n'):
+            if line[:1] in (b' ', b'\t'):
+                return None
+            name, _, value = line.partition(b':')
+            name = name.strip().lower()
+            value = value.strip()
+            if name == b'content-type':
+                part_ct = value.split(b';', 1)[0].strip().lower()
+            elif name == b'content-transfer-encoding':
+                if value.lower() not in _PLAIN_TRANSFER_ENCODINGS:
+                    return None
+            elif name == b'content-disposition':
+                if b'filename*' in value:
+                    return None
+                marker = value.find(b'filename=')
+                if marker >= 0:
+                    filename = value[marker + 9:].split(b';', 1)[0].strip().strip(b'"')
+
+        is_image = (
+            part_ct.startswith(b'image/') or
+            # Only the tail can hold the extension, so only it is lowercased
+            filename[-_IMAGE_FILENAME_EXTENSION_MAX:].lower().endswith(_IMAGE_FILENAME_EXTENSIONS_BYTES)
+        )
+        if is_image and next_pos > content_start:
+            image_bytes = body[content_start:next_pos]
+            return image_bytes, detect_image_type(image_bytes)
+
+        pos = next_pos + 2
+    return None
 
 
 def parse_multipart_image(body: bytes, content_type: str) -> tuple:
     """Parse multipart/form-data and extract first image part."""
-    from email.parser import BytesParser
-    from email.policy import default as email_policy
-
     try:
-        boundary = None
-        for part in content_type.split(';'):
-            part = part.strip()
-            if part.startswith('boundary='):
-                boundary = part[9:].strip('"\'')
-                break
+        match = MULTIPART_BOUNDARY_PATTERN.search(content_type)
+        boundary = match.group(1).rstrip().strip('"\'') if match else None
 
         if not boundary:
             logger.warning("No boundary found in multipart content-type")
             return None, 'bin'
 
-        full_msg = (
-            f'Content-Type: {content_type}\r\n'
-            f'MIME-Version: 1.0\r\n\r\n'
-        ).encode() + body
+        # Fast path: slice the image part straight out of the body
+        found = _scan_multipart_image(body, boundary)
+        if found is not None:
+            return found
 
-        parser = BytesParser(policy=email_policy)
-        msg = parser.parsebytes(full_msg)
+        # Feed the synthetic headers and the body separately, so the body is
+        # never copied into a concatenated message
+        parser = BytesFeedParser(policy=email_policy)
+        parser.feed(b'Content-Type: ' + content_type.encode() + _MIME_HEADER_END)
+        parser.feed(body)
+        msg = parser.close()
 
         if msg.is_multipart():
             for part in msg.iter_parts():
@@ -1113,10 +1928,7 @@ def parse_multipart_image(body: bytes, content_type: str) -> tuple:
 
                 is_image = (
                     part_ct.startswith('image/') or
-                    (filename and any(
-                        filename.lower().endswith(ext)
-                        for ext in ['.jpg', '.jpeg', '.png', '.webp']
-                    ))
+                    (filename and filename.lower().endswith(_IMAGE_FILENAME_EXTENSIONS))
                 )
 
                 if is_image:
@@ -1126,8 +1938,9 @@ def parse_multipart_image(body: bytes, content_type: str) -> tuple:
                         return image_bytes, ext
     except Exception as e:
         logger.warning(f"Multipart parsing error: {e}")
-        if is_image_data(body):
-            return body, detect_image_type(body)
+        image_type = _image_data_type(body)
+        if image_type is not None:
+            return body, image_type
 
     return None, 'bin'
 
@@ -1139,10 +1952,8 @@ def extract_image_from_body(body: bytes, content_type: str) -> tuple:
     if content_type.startswith('multipart/form-data'):
         return parse_multipart_image(body, content_type)
 
-    if is_image_data(body):
-        return body, detect_image_type(body)
-
-    if len(body) > 0 and is_image_data(body):
-        return body, detect_image_type(body)
+    image_type = _image_data_type(body)
+    if image_type is not None:
+        return body, image_type
 
     return None, 'bin'